@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import do_contour
+
+# On-disk cache for do_contour.analyse results
+# Entries live in <results_dir>/.analysis_cache and are keyed by the hash of the scan file
+# plus sigma, cut and do_contour.ANALYSIS_VERSION, so an edited file or a change to the
+# analysis never returns an old result. Least recently used entries are removed once the
+# cache grows past max_bytes
+
+CACHE_DIR_NAME = ".analysis_cache"
+MAX_CACHE_BYTES = 200 * 1024 * 1024
+
+# result entries stored as arrays, everything else goes into the JSON part
+ARRAY_KEYS = ["grid", "xVector", "thetaVector", "xNew", "thetaNew"]
+
+def cache_dir_for(results_dir):
+    return os.path.join(results_dir, CACHE_DIR_NAME)
+
+def file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as scanfile:
+        for block in iter(lambda: scanfile.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cache_key(content_hash, sigma, cut):
+    text = f"{content_hash}:{float(sigma)!r}:{float(cut)!r}:{do_contour.ANALYSIS_VERSION}"
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def _entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key + ".npz")
+
+def load(cache_dir, key):
+    entry = _entry_path(cache_dir, key)
+    try:
+        with np.load(entry, allow_pickle=False) as stored:
+            result = json.loads(str(stored["scalars"]))
+            for name in ARRAY_KEYS:
+                result[name] = stored[name]
+    except (OSError, KeyError, ValueError):
+        return None
+    # mark as recently used
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+    return result
+
+def store(cache_dir, key, result, max_bytes=MAX_CACHE_BYTES):
+    os.makedirs(cache_dir, exist_ok=True)
+    scalars = {}
+    for name, value in result.items():
+        if name in ARRAY_KEYS:
+            continue
+        scalars[name] = value if isinstance(value, (str, int)) else float(value)
+    # write to a temporary file first so readers in other processes never see half an entry
+    handle, temporary = tempfile.mkstemp(suffix=".npz", dir=cache_dir)
+    with os.fdopen(handle, 'wb') as entry:
+        np.savez(entry, scalars=np.array(json.dumps(scalars)),
+                 **{name: np.asarray(result[name]) for name in ARRAY_KEYS})
+    os.replace(temporary, _entry_path(cache_dir, key))
+    evict(cache_dir, max_bytes)
+
+def evict(cache_dir, max_bytes=MAX_CACHE_BYTES):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".npz"):
+            continue
+        try:
+            info = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        entries.append((info.st_mtime, info.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        total -= size
+
+# Same result as do_contour.analyse(filename, sigma, cut), from the cache when possible
+# result["cached"] tells whether it was a hit
+def cached_analyse(filename, sigma=0.6, cut=0.3, cache_dir=None, max_bytes=MAX_CACHE_BYTES):
+    if cache_dir is None:
+        cache_dir = cache_dir_for(os.path.dirname(os.path.abspath(filename)))
+    key = cache_key(file_hash(filename), sigma, cut)
+    result = load(cache_dir, key)
+    if result is not None:
+        result["cached"] = True
+        return result
+    result = do_contour.analyse(filename, sigma, cut)
+    try:
+        store(cache_dir, key, result, max_bytes)
+    except OSError as e:
+        print("Unable to cache analysis result", e)
+    result["cached"] = False
+    return result
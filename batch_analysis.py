@@ -0,0 +1,98 @@
+import argparse
+import csv
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import analysis_cache
+import scan_catalog
+
+# Batch reanalysis
+# Runs do_contour.analyse (through analysis_cache) on every scan in a directory with a process pool and
+# writes one summary row per file, e.g. after changing sigma or cut:
+#   python batch_analysis.py D:/emittance_results --sigma 0.8 --cut 0.25 -o summary.csv
+
+SUMMARY_FIELDS = ["file", "comment", "beam_energy", "emittance", "x2RMS", "theta2RMS",
+                  "sigma", "cut", "error"]
+
+# one file, runs in a worker process
+def summarise(filename, sigma=0.6, cut=0.3):
+    summary = {"file": os.path.basename(filename), "sigma": sigma, "cut": cut, "error": ""}
+    try:
+        result = analysis_cache.cached_analyse(filename, sigma, cut)
+    except Exception as e:
+        summary["error"] = repr(e)
+        return summary
+    for key in ["comment", "beam_energy", "emittance", "x2RMS", "theta2RMS"]:
+        value = result[key]
+        summary[key] = value if isinstance(value, str) else float(value)
+    return summary
+
+# summary rows as a JSON list, NaN (e.g. a scan without beam) is not valid JSON and becomes null
+def write_json(rows, filename):
+    cleaned = [{key: None if isinstance(value, float) and value != value else value
+                for key, value in row.items()} for row in rows]
+    with open(filename, 'w') as jsonfile:
+        json.dump(cleaned, jsonfile, indent=2)
+
+# .dat and binary .scan files matching pattern
+def find_scans(directory, pattern="datafile_*"):
+    return sorted(filename for filename in glob.glob(os.path.join(directory, pattern))
+                  if filename.endswith(scan_catalog.SCAN_EXTENSIONS))
+
+# Analyse every scan in directory, callback gets each summary as soon as it is done
+# If output ends in .csv rows are written (and flushed) as they arrive, .json is
+# written at the end. Returns the summaries sorted by file name
+def analyse_directory(directory, sigma=0.6, cut=0.3, output=None, workers=None,
+                      pattern="datafile_*", callback=None):
+    files = find_scans(directory, pattern)
+    summaries = []
+    csvfile = None
+    writer = None
+    if output and not output.endswith(".json"):
+        csvfile = open(output, 'w', newline='')
+        writer = csv.DictWriter(csvfile, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(summarise, filename, sigma, cut) for filename in files]
+            for future in as_completed(futures):
+                summary = future.result()
+                summaries.append(summary)
+                if writer:
+                    writer.writerow(summary)
+                    csvfile.flush()
+                if callback:
+                    callback(summary)
+    finally:
+        if csvfile:
+            csvfile.close()
+
+    summaries.sort(key=lambda summary: summary["file"])
+    if output and output.endswith(".json"):
+        write_json(summaries, output)
+    return summaries
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reanalyse every emittance scan in a directory")
+    parser.add_argument("directory")
+    parser.add_argument("--sigma", type=float, default=0.6)
+    parser.add_argument("--cut", type=float, default=0.3)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default one per core")
+    parser.add_argument("--pattern", default="datafile_*", help="file name pattern, only .dat and .scan files are analysed")
+    parser.add_argument("-o", "--output", default=None, help="summary file (.csv or .json), default <directory>/analysis_summary.csv")
+    args = parser.parse_args(argv)
+
+    output = args.output or os.path.join(args.directory, "analysis_summary.csv")
+    def report(summary):
+        if summary["error"]:
+            print(summary["file"], "failed:", summary["error"])
+        else:
+            print(summary["file"], "emittance", round(summary["emittance"], 3))
+    summaries = analyse_directory(args.directory, args.sigma, args.cut, output, args.workers,
+                                  args.pattern, report)
+    print(len(summaries), "files analysed, summary written to", output)
+
+if __name__ == "__main__":
+    main()
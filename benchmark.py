@@ -0,0 +1,213 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+
+import do_contour
+import motor_control_fake
+import motor_control_galil as mc
+import scan_engine
+
+# Benchmarks
+# Analysis: synthetic beams are written as .dat files in the scan_engine header format and
+# timed through each stage of do_contour.analyse (parse, filter, background cut, moments)
+# Scans: scan_engine.run_scan against motor_control_fake.SimulatedGalil, wall time, simulated
+# time and command count
+# Results go to a JSON file, --compare prints the ratios against an earlier run:
+#   python benchmark.py -o before.json
+#   python benchmark.py -o after.json --compare before.json
+
+ANALYSIS_SIZES = [(10, 50), (50, 250), (100, 500), (500, 2500), (1000, 5000)]  # positions x voltages
+SCAN_SIZE = (10, 50)
+SCAN_MODES = {
+    "step": {"settle": True},
+    "serpentine": {"settle": True, "serpentine": True},
+    "adaptive": {"settle": True, "adaptive": True},
+    "controller_sweep": {"settle": True, "controller_sweep": True},
+}
+DISTRIBUTIONS = ["gaussian", "halo"]
+
+# Synthetic beams
+# A correlated Gaussian in normalised (position, voltage) coordinates, "halo" adds a wide
+# low component around the core. Readings get a background offset and noise and are
+# rounded like the controller's MG output. The same seed always gives the same file
+def make_beam(position_steps, voltage_steps, distribution="gaussian", seed=0,
+              width=0.15, correlation=0.5, halo_fraction=0.05, halo_width=3.0,
+              background=0.01, noise=0.002):
+    rng = np.random.default_rng(seed)
+    u = np.linspace(-1, 1, position_steps)[:, None] / width
+    v = np.linspace(-1, 1, voltage_steps)[None, :] / width
+    def gaussian(u, v):
+        return np.exp(-(u * u - 2 * correlation * u * v + v * v) / (2 * (1 - correlation ** 2)))
+    grid = gaussian(u, v)
+    if distribution == "halo":
+        grid = grid + halo_fraction * gaussian(u / halo_width, v / halo_width)
+    elif distribution != "gaussian":
+        raise ValueError("unknown distribution " + distribution)
+    grid = grid + background + rng.normal(0, noise, grid.shape)
+    return np.round(grid, 4)
+
+def synthetic_scan(filename, position_steps, voltage_steps):
+    return {
+        "filename": filename,
+        "comment": f"synthetic {position_steps}x{voltage_steps}",
+        "energy": 25000,
+        "motor_start_mm": 0.0,
+        "steps_to_mm": 1e-4,
+        "start_motor": 0,
+        "end_motor": 1000 * position_steps,
+        "motor_num_steps": position_steps,
+        "start_voltage": -2,
+        "end_voltage": 2,
+        "voltage_num_steps": voltage_steps,
+    }
+
+# write a synthetic beam like do_measurement does, returns the file name
+def write_beam_file(directory, position_steps, voltage_steps, distribution="gaussian", seed=0):
+    filename = os.path.join(directory, f"synthetic_{distribution}_{position_steps}x{voltage_steps}_{seed}.dat")
+    if os.path.exists(filename):
+        return filename
+    grid = make_beam(position_steps, voltage_steps, distribution, seed)
+    with open(filename + ".tmp", 'w') as datafile:
+        scan_engine.write_header(datafile, synthetic_scan(filename, position_steps, voltage_steps))
+        for row in grid:
+            scan_engine.write_row(datafile, row)
+    os.replace(filename + ".tmp", filename)
+    return filename
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), value
+
+# time each stage of do_contour.analyse on one file, stages run in order on the previous output
+def bench_analysis(filename, repeat=3, sigma=0.6, cut=0.3):
+    parse_s, (header, data) = best_of(lambda: do_contour.read_scan(filename), repeat)
+    filter_s, df = best_of(lambda: do_contour.smooth(data, sigma), repeat)
+    cut_s, df = best_of(lambda: do_contour.background_cut(df.copy(), cut), repeat)
+    xVector, thetaVector, _, _ = do_contour.phase_space_axes(header)
+    moments_s, moments = best_of(lambda: do_contour.beam_moments(df, xVector, thetaVector), repeat)
+    return {
+        "file": os.path.basename(filename),
+        "positions": header["position_steps"],
+        "voltages": header["voltage_steps"],
+        "file_bytes": os.path.getsize(filename),
+        "parse_s": parse_s,
+        "filter_s": filter_s,
+        "cut_s": cut_s,
+        "moments_s": moments_s,
+        "total_s": parse_s + filter_s + cut_s + moments_s,
+        "emittance": float(moments[2]),
+    }
+
+# run one scan mode against the simulator with simulated time time_scale times faster,
+# returns wall time, simulated time and command count
+def bench_scan(directory, mode, size=SCAN_SIZE, latency=0.002, jitter=0.0005, time_scale=10.0):
+    position_steps, voltage_steps = size
+    scan = synthetic_scan(os.path.join(directory, f"scan_{mode}.dat"), position_steps, voltage_steps)
+    scan.update(SCAN_MODES[mode])
+    beam = {"position": scan["end_motor"] / 2, "position_width": scan["end_motor"] / 6, "voltage_width": 0.6}
+    simulator = motor_control_fake.install(latency, jitter, time_scale, beam=beam, start_position=0)
+    try:
+        mc.setup("simulated")
+        start = time.perf_counter()
+        simulated_start = simulator.clock.monotonic()
+        completed = scan_engine.run_scan(scan)
+        wall_s = time.perf_counter() - start
+        simulated_s = simulator.clock.monotonic() - simulated_start
+    finally:
+        motor_control_fake.install(latency, jitter)
+    points = position_steps * voltage_steps
+    return {
+        "mode": mode,
+        "positions": position_steps,
+        "voltages": voltage_steps,
+        "completed": completed,
+        "wall_s": wall_s,
+        "simulated_s": simulated_s,
+        "commands": simulator.commands,
+        "ms_per_point": 1000 * simulated_s / points,
+        "latency": latency,
+        "jitter": jitter,
+        "time_scale": time_scale,
+    }
+
+def parse_size(text):
+    positions, voltages = text.lower().split("x")
+    return int(positions), int(voltages)
+
+# ratio of every timing in new to the matching entry of old
+def compare(old, new):
+    for section, key in [("analysis", "file"), ("scan", "mode")]:
+        previous = {entry[key]: entry for entry in old.get(section, [])}
+        for entry in new.get(section, []):
+            if entry[key] not in previous:
+                continue
+            ratios = [f"{name} x{entry[name] / previous[entry[key]][name]:.2f}"
+                      for name in entry if name.endswith("_s") and previous[entry[key]].get(name)]
+            print(f"{section} {entry[key]}: " + ", ".join(ratios))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the analysis and the scan engine")
+    parser.add_argument("-o", "--output", default="benchmark.json")
+    parser.add_argument("--data-dir", default="benchmark_data", help="synthetic files are written here and reused")
+    parser.add_argument("--sizes", default=",".join(f"{p}x{v}" for p, v in ANALYSIS_SIZES),
+                        help="analysis grid sizes, positions x voltages, e.g. 10x50,100x500")
+    parser.add_argument("--distributions", default=",".join(DISTRIBUTIONS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--scan-size", default=f"{SCAN_SIZE[0]}x{SCAN_SIZE[1]}")
+    parser.add_argument("--scan-modes", default=",".join(SCAN_MODES), help="empty to skip the scan benchmarks")
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated round trip per call (s)")
+    parser.add_argument("--jitter", type=float, default=0.0005, help="simulated latency jitter (s)")
+    parser.add_argument("--time-scale", type=float, default=10.0, help="simulated time runs this many times faster")
+    parser.add_argument("--compare", default=None, help="earlier result file to compare with")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "analysis": [],
+        "scan": [],
+    }
+    for distribution in [d for d in args.distributions.split(",") if d]:
+        for size in [parse_size(s) for s in args.sizes.split(",") if s]:
+            filename = write_beam_file(args.data_dir, *size, distribution)
+            entry = bench_analysis(filename, args.repeat)
+            entry["distribution"] = distribution
+            results["analysis"].append(entry)
+            print(f"{entry['file']}: parse {entry['parse_s']:.4f} s, filter {entry['filter_s']:.4f} s, "
+                  f"cut {entry['cut_s']:.4f} s, moments {entry['moments_s']:.4f} s")
+    for mode in [m for m in args.scan_modes.split(",") if m]:
+        entry = bench_scan(args.data_dir, mode, parse_size(args.scan_size), args.latency, args.jitter,
+                           args.time_scale)
+        results["scan"].append(entry)
+        print(f"scan {mode}: {entry['simulated_s']:.2f} s simulated ({entry['wall_s']:.2f} s wall), "
+              f"{entry['commands']} commands, {entry['ms_per_point']:.2f} ms per point")
+
+    with open(args.output, 'w') as jsonfile:
+        json.dump(results, jsonfile, indent=2)
+    print("results written to", args.output)
+    if args.compare:
+        with open(args.compare) as jsonfile:
+            compare(json.load(jsonfile), results)
+
+if __name__ == "__main__":
+    main()
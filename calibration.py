@@ -0,0 +1,55 @@
+import time
+
+import motor_control_galil as mc
+
+# Calibration
+# The three limit switches are a fixed distance apart, so standing on any one of them gives
+# the motor position of all three. Used by the GUI (emittance_scanner.py) and by scan_runner.py
+# This file must not import PySide6
+#
+# Reverse limit, home and forward switch of the Galil are Home (Park), Faraday and End here
+FARADAY_OFFSET = 3679098    # steps from Home to Faraday
+END_OFFSET = 2578395        # steps from Faraday to End
+TRAVEL_MM = 193             # Home to End, for the position display and mm inputs
+HEADER_TRAVEL_MM = 196      # Home to End as written to the scan header (steps_to_mm)
+
+# move towards the home switch unless already standing on a switch, returns once stopped
+def find_switch(poll=0.1):
+    if mc.check_forward_switch() or mc.check_home_switch() or mc.check_reverse_switch():
+        print("already at limit switch")
+        return
+    mc.find_edge()
+    while mc.is_in_motion():
+        time.sleep(poll)
+
+# {"home", "faraday", "end"} from a status snapshot taken at a switch, None if at none
+def from_snapshot(snapshot):
+    calibration = None
+    if snapshot["reverse"]:
+        home = snapshot["position"]
+        calibration = {"home": home, "faraday": home + FARADAY_OFFSET,
+                       "end": home + FARADAY_OFFSET + END_OFFSET}
+        print("At reverse switch!")
+    if snapshot["home"]:
+        faraday = snapshot["position"]
+        calibration = {"home": faraday - FARADAY_OFFSET, "faraday": faraday, "end": faraday + END_OFFSET}
+        print("At home switch!")
+    if snapshot["forward"]:
+        end = snapshot["position"]
+        calibration = {"home": end - END_OFFSET - FARADAY_OFFSET, "faraday": end - END_OFFSET, "end": end}
+        print("At forward switch!")
+    return calibration
+
+# find a switch and read the calibration there
+def calibrate():
+    find_switch()
+    return from_snapshot(mc.get_status_snapshot(max_age=0))
+
+def position_in_mm(calibration, position):
+    return round((position - calibration["home"]) / (calibration["end"] - calibration["home"]) * TRAVEL_MM, 2)
+
+def position_from_mm(calibration, mm):
+    return int((float(mm) / TRAVEL_MM) * (calibration["end"] - calibration["home"]) + calibration["home"])
+
+def steps_to_mm(calibration):
+    return HEADER_TRAVEL_MM / (calibration["end"] - calibration["home"])
@@ -1,6 +1,10 @@
 import numpy as np
-from matplotlib import pyplot as plt
-from scipy.ndimage import gaussian_filter
+
+import scan_format
+
+# matplotlib.pyplot and scipy.ndimage take most of the import time, they are imported where
+# they are used so that modules which only read files or keep a StreamingEmittance
+# (scan_engine, the GUI at startup) do not pay for them
 
 # Data processing; you can invoke load_file and run from a shell if you just want to analyse existing data
 
@@ -19,109 +23,325 @@ def get_two_values_from_line():
   print(vals)
   return [float(vals[0]),float(vals[1])]
 
-def run():
-    user_comment = get_line()
-    plate_length, plate_gap = get_two_values_from_line()
-    beam_energy = float(get_line())
-    motor_start = float(get_line())
-    motor_step_size = float(get_line())
-    voltage_min  = float(get_line())*100
-    voltage_step_size = float(get_line())*100
-    voltage_steps = int(get_line())
-    position_steps = int(get_line())
-
-    voltage_max = voltage_min + voltage_step_size * voltage_steps
-    motor_end = motor_start + motor_step_size * position_steps
-
-    thetaConversionConstant = plate_length * 1000 / (beam_energy * 4 * plate_gap)
-
-    xVector = [motor_start + i * (motor_end - motor_start) / position_steps for i in range(position_steps)]
-    thetaVector = [voltage_min + i * (voltage_max - voltage_min) / voltage_steps for i in range(voltage_steps)]
-
-    thetaVector = [thetaVectorI * thetaConversionConstant for thetaVectorI in thetaVector]
-
-    print("thetaVector: ", len(thetaVector))
-
-    print("Comment: ", user_comment)
-    print("Plate Gap: ", plate_gap)
-    print("Plate Length: ", plate_length)
-    print("Beam Energy: ", beam_energy)
-    print("Start and End Positions: ", "{} - {}".format(motor_start, motor_end))
-    print("Start and End Voltage: ", "{} - {}".format(voltage_min, voltage_max))
-    print("Start and End Theta: ", "{} - {}".format(thetaVector[0], thetaVector[len(thetaVector) - 1]))
-    print("Voltage Steps: ", voltage_steps)
-    print("Position Steps: ", position_steps)
-
-    lines = file.readlines()
-
-    data = []
-
-    # Each row is a different voltage, each element is a different position
-    for line in lines:
-      data += [list(map(float, line.strip().split(' ')))]
-
-    sigma = 0.6 # can be an user input
-    data = gaussian_filter(data, sigma)
-    df = data.T
-    df = gaussian_filter(df, sigma)
-
-    # background cut
-    cut = 0.3
-    for j in range(position_steps):
-        for i in range(voltage_steps-1):
-            if (df[i,j] != 0) and (df[i-1,j] < cut*np.max(df)) and (df[i+1,j] < cut*np.max(df)):
-                df[i,j] = 0
-
-    for i in range(voltage_steps):
-        for j in range(position_steps-1):
-            if (df[i,j] != 0) and (df[i,j-1] < cut*np.max(df)) and (df[i,j+1] < cut*np.max(df)):
-                df[i,j] = 0
-    #===============================
+# Background cut
+# An element is zeroed when it is non-zero and both of its neighbours along a line are
+# below cut * max. Works like the original element by element loops, including the
+# order they run in: a zeroed element counts as a small neighbour for the next one,
+# index -1 wraps around to the last element, the last element of a line is never cut,
+# and the threshold is recomputed whenever a cut changes the maximum.
+# Lines are the columns of a; each pass is vectorized across all lines at once.
+def _background_cut_pass(a, cut):
+    n, m = a.shape
+    first_line = 0
+    first_k = 0
+    while first_line < m and n > 1:
+        peak = np.max(a)
+        threshold = cut * peak
+        block = a[:, first_line:]
+        before = block.copy()
+        zeroed = np.zeros(block.shape, dtype=bool)
+        for k in range(n - 1):
+            cond = (block[k] != 0) & (block[k - 1] < threshold) & (block[k + 1] < threshold)
+            if k < first_k:
+                cond[0] = False
+            block[k, cond] = 0
+            zeroed[k] = cond
+
+        # find the first cut (in loop order: line by line) that changes the maximum
+        events = np.flatnonzero(zeroed.T.ravel())
+        if len(events) == 0:
+            return
+        if peak < 0:
+            # zeroing anything raises the maximum to 0
+            change = events[0]
+        else:
+            # the maximum only drops once its last occurrence has been cut
+            if np.count_nonzero(a == peak) > 0:
+                return
+            change = events[before.T.ravel()[events] == peak][-1]
+
+        # keep everything up to that cut, redo the rest with the new maximum
+        line, k = divmod(change, n)
+        block[k + 1:, line] = before[k + 1:, line]
+        block[:, line + 1:] = before[:, line + 1:]
+        first_line += line
+        first_k = k + 1
+        if first_k >= n - 1:
+            first_line += 1
+            first_k = 0
+
+def background_cut(df, cut):
+    # along voltage for each position, then along position for each voltage
+    _background_cut_pass(df, cut)
+    _background_cut_pass(df.T, cut)
+    return df
+
+# RMS size, divergence and emittance of a (voltage, position) grid
+def beam_moments(df, xVector, thetaVector):
+    voltage_steps, position_steps = df.shape
+    xVector = np.asarray(xVector, dtype=float)
+    thetaVector = np.asarray(thetaVector, dtype=float)
 
-
-    #RMS calculation
     xS = df.sum(axis=0) * (1/(voltage_steps))
     thetaS = df.sum(axis=1) * (1/position_steps)
 
-
     summationX = xS.sum()
     summationTheta = thetaS.sum()
 
-
-    xWeighted = sum([xVector[i] * xS[i] for i in range (position_steps)]) / summationX
-    thetaWeighted = sum([thetaVector[i] * thetaS[i] for i in range (voltage_steps)]) / summationTheta
+    xWeighted = np.dot(xVector, xS) / summationX
+    thetaWeighted = np.dot(thetaVector, thetaS) / summationTheta
 
     xNew = xVector - xWeighted
     thetaNew = thetaVector - thetaWeighted
 
+    x2RMS = 2 * np.sqrt(np.dot(np.square(xNew), xS) * (1/summationX))
+    theta2RMS = 2 * np.sqrt(np.dot(np.square(thetaNew), thetaS) * (1/summationTheta))
 
-    x2RMS = 2 * np.sqrt(sum([(np.square(xNew[i]) * xS[i]) for i in range(position_steps)]) * (1/summationX))
-    theta2RMS = 2 * np.sqrt(sum([(np.square(thetaNew[i]) * thetaS[i]) for i in range(voltage_steps)]) * (1/summationTheta))
-
-    summationAllValues = sum(df.sum(axis=0))
+    summationAllValues = df.sum()
 
     emittance = x2RMS*theta2RMS*np.sqrt(1-np.square(np.dot(df.dot(xNew),thetaNew)/x2RMS/theta2RMS*4/summationAllValues))
+    return x2RMS, theta2RMS, emittance, xNew, thetaNew
+
+HEADER_LINES = 9
+# bump whenever a change to analyse() changes its results, invalidates analysis_cache entries
+ANALYSIS_VERSION = 1
+
+# Header of a scan file as written by scan_engine.write_header, values as in the file
+def parse_header(lines):
+    plate_length, plate_gap = lines[1].strip().split(" ")[:2]
+    return {
+        "comment": lines[0].strip(),
+        "plate_length": float(plate_length),
+        "plate_gap": float(plate_gap),
+        "beam_energy": float(lines[2]),
+        "motor_start": float(lines[3]),
+        "motor_step_size": float(lines[4]),
+        "voltage_min": float(lines[5]),
+        "voltage_step_size": float(lines[6]),
+        "voltage_steps": int(lines[7]),
+        "position_steps": int(lines[8]),
+    }
+
+# Each row is a different position, each element is a different voltage
+def parse_data(lines):
+    return np.array([list(map(float, line.strip().split(' '))) for line in lines if line.strip() != ""])
+
+# Read a scan from a file name, the bytes of a file or an open text file
+# Binary .scan files (scan_format) are memory mapped instead of parsed
+# Returns the header dict and the raw data (positions x voltages)
+def read_scan(source):
+    if scan_format.is_binary_scan(source):
+        header, data, _ = scan_format.read_scan(source)
+        return header, data
+    if isinstance(source, bytes):
+        lines = source.decode().splitlines()
+    elif hasattr(source, "readlines"):
+        lines = source.readlines()
+    else:
+        with open(source, 'r') as scanfile:
+            lines = scanfile.readlines()
+    return parse_header(lines[:HEADER_LINES]), parse_data(lines[HEADER_LINES:])
+
+# x (mm) of each position and theta (mrad) of each voltage of a scan, plus the
+# end of the motor and voltage ranges
+def phase_space_axes(header):
+    plate_length = header["plate_length"]
+    plate_gap = header["plate_gap"]
+    beam_energy = header["beam_energy"]
+    motor_start = header["motor_start"]
+    motor_step_size = header["motor_step_size"]
+    voltage_min = header["voltage_min"]*100
+    voltage_step_size = header["voltage_step_size"]*100
+    voltage_steps = header["voltage_steps"]
+    position_steps = header["position_steps"]
+
+    voltage_max = voltage_min + voltage_step_size * voltage_steps
+    motor_end = motor_start + motor_step_size * position_steps
+
+    thetaConversionConstant = plate_length * 1000 / (beam_energy * 4 * plate_gap)
 
+    xVector = motor_start + np.arange(position_steps) * (motor_end - motor_start) / position_steps
+    thetaVector = voltage_min + np.arange(voltage_steps) * (voltage_max - voltage_min) / voltage_steps
 
-    print("Emittance: " + str(emittance))
+    thetaVector = thetaVector * thetaConversionConstant
+    return xVector, thetaVector, motor_end, voltage_max
 
-    fig0, ax0 = plt.subplots(figsize=(7, 8), facecolor = 'w', edgecolor = 'k')
+# Gaussian filter of the raw data (positions x voltages), returns the (voltage, position) grid
+def smooth(data, sigma):
+    from scipy.ndimage import gaussian_filter
+    data = gaussian_filter(np.asarray(data, dtype=float), sigma)
+    df = data.T
+    df = gaussian_filter(df, sigma)
+    return df
+
+# Online estimate of the emittance while a scan is running
+# Keeps weighted sums of 1, x, theta, x^2, theta^2 and x*theta over the rows seen so far,
+# so each new row costs one pass over that row. Raw readings are used (no smoothing):
+# a point counts with its height above the background (median of the rows so far) if
+# it reaches cut * peak, like the background cut. When a new peak raises that threshold
+# the sums are rebuilt from the stored rows
+# The moments are the ones beam_moments computes: emittance = 4 sqrt(<x^2><theta^2> - <x theta>^2)
+class StreamingEmittance:
+    def __init__(self, header, cut=0.3):
+        self.xVector, self.thetaVector, _, _ = phase_space_axes(header)
+        self.cut = cut
+        self.rows = {}
+        self.peak = -np.inf
+        self.background = 0.0
+        self.sums = np.zeros(6)
+        self.history = []       # emittance after each row
+        self.empty_rows = 0     # rows without beam since the last one with beam
+
+    def _weights(self, row):
+        weights = row - self.background
+        weights[weights < self.cut * (self.peak - self.background)] = 0
+        return weights
+
+    def _row_sums(self, index, row):
+        weights = self._weights(row)
+        x = self.xVector[index]
+        total = weights.sum()
+        theta = np.dot(weights, self.thetaVector)
+        theta2 = np.dot(weights, np.square(self.thetaVector))
+        return np.array([total, x * total, theta, x * x * total, theta2, x * theta])
+
+    def _rebuild(self):
+        self.background = float(np.median(np.concatenate(list(self.rows.values()))))
+        self.sums = np.zeros(6)
+        for index, row in self.rows.items():
+            self.sums += self._row_sums(index, row)
+
+    # add the readings at position index, returns the new estimate
+    def add_row(self, index, row):
+        row = np.asarray(row, dtype=float)
+        self.rows[index] = row
+        if row.max() > self.peak:
+            self.peak = row.max()
+            self._rebuild()
+            row_weight = self.sums[0]
+        else:
+            row_sums = self._row_sums(index, row)
+            self.sums += row_sums
+            row_weight = row_sums[0]
+        self.empty_rows = 0 if row_weight > 0 else self.empty_rows + 1
+        estimate = self.estimate()
+        self.history.append(estimate["emittance"])
+        return estimate
+
+    def estimate(self):
+        total, x, theta, x2, theta2, xtheta = self.sums
+        estimate = {"rows": len(self.rows), "emittance": np.nan, "x2RMS": np.nan, "theta2RMS": np.nan}
+        if total <= 0:
+            return estimate
+        varX = max(x2 / total - (x / total) ** 2, 0)
+        varTheta = max(theta2 / total - (theta / total) ** 2, 0)
+        covariance = xtheta / total - (x / total) * (theta / total)
+        estimate["x2RMS"] = 2 * np.sqrt(varX)
+        estimate["theta2RMS"] = 2 * np.sqrt(varTheta)
+        estimate["emittance"] = 4 * np.sqrt(max(varX * varTheta - covariance ** 2, 0))
+        return estimate
+
+    # True once the beam has been passed: the last empty_rows rows had no beam after
+    # rows that did, and the estimate moved less than tolerance (relative) over them
+    def converged(self, tolerance=0.02, empty_rows=3):
+        if self.empty_rows < empty_rows or len(self.history) <= empty_rows or self.sums[0] <= 0:
+            return False
+        recent = np.array(self.history[-empty_rows - 1:])
+        if np.isnan(recent).any():
+            return False
+        return (recent.max() - recent.min()) <= tolerance * abs(recent[-1])
+
+# Analyse a scan without printing or plotting
+# source is anything read_scan accepts, or a data array together with its header dict
+# Returns a dict with the header fields, the filtered grid (voltages x positions),
+# x2RMS, theta2RMS, emittance and the x and theta vectors
+def analyse(source, sigma=0.6, cut=0.3, header=None):
+    if isinstance(source, np.ndarray):
+        data = source
+    else:
+        header, data = read_scan(source)
+
+    xVector, thetaVector, motor_end, voltage_max = phase_space_axes(header)
+
+    df = smooth(data, sigma)
+
+    # background cut
+    background_cut(df, cut)
+
+    #RMS calculation
+    x2RMS, theta2RMS, emittance, xNew, thetaNew = beam_moments(df, xVector, thetaVector)
+
+    result = dict(header)
+    result.update({
+        "sigma": sigma,
+        "cut": cut,
+        "motor_end": motor_end,
+        "voltage_max": voltage_max,
+        "grid": df,
+        "xVector": xVector,
+        "thetaVector": thetaVector,
+        "xNew": xNew,
+        "thetaNew": thetaNew,
+        "x2RMS": x2RMS,
+        "theta2RMS": theta2RMS,
+        "emittance": emittance,
+    })
+    return result
+
+def print_summary(result):
+    thetaVector = result["thetaVector"]
+    print("thetaVector: ", len(thetaVector))
+
+    print("Comment: ", result["comment"])
+    print("Plate Gap: ", result["plate_gap"])
+    print("Plate Length: ", result["plate_length"])
+    print("Beam Energy: ", result["beam_energy"])
+    print("Start and End Positions: ", "{} - {}".format(result["motor_start"], result["motor_end"]))
+    print("Start and End Voltage: ", "{} - {}".format(result["voltage_min"]*100, result["voltage_max"]))
+    print("Start and End Theta: ", "{} - {}".format(thetaVector[0], thetaVector[len(thetaVector) - 1]))
+    print("Voltage Steps: ", result["voltage_steps"])
+    print("Position Steps: ", result["position_steps"])
+    print("Emittance: " + str(result["emittance"]))
+
+# Draw the filtered grid and the RMS values, into ax if given, otherwise into a new figure
+def plot(result, ax=None):
+    if ax is None:
+        from matplotlib import pyplot as plt
+        fig0, ax0 = plt.subplots(figsize=(7, 8), facecolor = 'w', edgecolor = 'k')
+    else:
+        ax0 = ax
+        fig0 = ax.figure
 
     #cnt = plt.contourf(xNew,thetaNew,df, 50, cmap='jet')
-    plt.imshow(df, cmap='jet')
-    cbar = plt.colorbar()
+    image = ax0.imshow(result["grid"], cmap='jet')
+    cbar = fig0.colorbar(image, ax=ax0)
     cbar.set_label("Voltage read (V)")
 
     ax0.set_xlabel('mm', fontsize=18)
     ax0.set_ylabel('mrad', fontsize=18)
-    plt.yticks(fontsize=20)
-    plt.xticks(fontsize=20)
-    calc1 = '\n'.join((r'$2y_{RMS}$ = %.1f mm' % (x2RMS, ),r'$2y^{\prime}_{RMS}$ = %.1f mrad' % (theta2RMS, ),r'$4\epsilon_{RMS}$ = %.1f $\mu$m' % (emittance, )))
+    ax0.tick_params(labelsize=20)
+    calc1 = '\n'.join((r'$2y_{RMS}$ = %.1f mm' % (result["x2RMS"], ),r'$2y^{\prime}_{RMS}$ = %.1f mrad' % (result["theta2RMS"], ),r'$4\epsilon_{RMS}$ = %.1f $\mu$m' % (result["emittance"], )))
     ax0.text(0.46, 0.03, calc1, transform = ax0.transAxes, color = 'w', fontsize = 18)
-    plt.tight_layout()
-
+    fig0.tight_layout()
+    return fig0
+
+# print and show a blocking plot window for a result
+def show_result(result):
+    from matplotlib import pyplot as plt
+    print_summary(result)
+    plot(result)
     plt.show()
+    return result
+
+# analyse, print and show a blocking plot window, like run()
+def show(source, sigma=0.6, cut=0.3):
+    return show_result(analyse(source, sigma, cut))
+
+# Analyse the file opened with load_file
+def run():
+    return show(file)
 
 if __name__ == "__main__":
-   load_file()
+   import sys
+   load_file(sys.argv[1] if len(sys.argv) > 1 else filename)
    run()
@@ -1,5 +1,6 @@
+import startup_timing    # first, so --startup-report can time the imports below
 from PySide6.QtWidgets import QVBoxLayout, QLabel, QPushButton, QWidget, QMainWindow, QApplication
-from PySide6.QtCore import QTimer, QRunnable, Slot, Signal, QObject, QThreadPool
+from PySide6.QtCore import QRunnable, Slot, Signal, QObject, QThreadPool, QTimer
 
 import json
 import sys
@@ -7,11 +8,16 @@ import time
 import traceback
 import os
 
+from startup_timing import phase
+import batch_analysis
+import calibration
+import plot_view
 import pysides
-import numpy as np
+import scan_catalog
+import scan_engine
 
 # For development, a placeholder file is available that simulates a Galil microprocessor
-#import motor_control_fake as mc
+#import motor_control_fake as mc    # simulated controller, no hardware needed
 import motor_control_galil as mc
 from pysides import object_map
 
@@ -21,10 +27,8 @@ from pysides import object_map
 
 # application in global values cause I was in a rush
 running = True
-keepCheckingStatus = True   
 currentPosition = 0
 currentStatus = 0
-currentOutputVoltage = 0
 currentInputVoltage = 0
 PROPERTIES_FILE_NAME = "properties.json"
 full_path = os.path.realpath(__file__)
@@ -32,24 +36,26 @@ script_path, _ = os.path.split(full_path)
 properties_file_path = os.path.join(script_path, PROPERTIES_FILE_NAME)
 
 # Static buttons
+# Controller calls from the GUI thread are queued on the I/O thread with mc.submit
+# and not waited for, so a slow controller never freezes the window
 @Slot()
 def goHome():
-    mc.set_speed(200000)
-    mc.move_to_position(pysides.auto_Home)
-    mc.set_speed(50000)
+    mc.submit(mc.move_to_position, pysides.auto_Home, speed=200000, final_speed=50000)
 
 
 @Slot()
 def goFaraday():
-    mc.set_speed(200000)
-    mc.move_to_position(pysides.auto_Faraday)
-    mc.set_speed(50000)
+    mc.submit(mc.move_to_position, pysides.auto_Faraday, speed=200000, final_speed=50000)
+
+def stopEverything():
+    mc.send_commands(['HX1', 'AO2,0', 'SP50000', 'ST', 'AB'])
+    mc.invalidate_status()
 
 @Slot()
 def goAbort():
     # send signal to stop running threads
-    global currentOutputVoltage
-    currentOutputVoltage = 0
+    scan_engine.abort()
+    scan_engine.output_voltage = 0
     global running
     running = False
 
@@ -59,10 +65,8 @@ def goAbort():
     pysides.object_map["lblAuto"].setText("Initiate Auto Scan")
     pysides.object_map["lblStart"].setText("Initiate Custom Scan")
 
-    # set output values to defaults
-    mc.set_output_voltage(0)
-    mc.set_speed(50000)
-    mc.stop_motor()
+    # set output values to defaults, ahead of anything still queued
+    mc.submit(stopEverything, urgent=True)
 
 def getMeasurementSettings():
     # get auto or user specified settings
@@ -101,20 +105,51 @@ def getMeasurementSettings():
     except Exception as e:
         print("Failed to load user settings", e)
 
+    settings["controller_sweep"] = object_map["checkControllerSweep"].isChecked()
+    settings["fly_scan"] = object_map["checkFlyScan"].isChecked()
+    settings["settle"] = object_map["checkSettle"].isChecked()
+    settings["serpentine"] = object_map["checkSerpentine"].isChecked()
+    settings["adaptive"] = object_map["checkAdaptive"].isChecked()
+    settings["binary"] = object_map["checkBinaryFile"].isChecked()
+    settings["early_stop"] = object_map["checkEarlyStop"].isChecked()
+    try:
+        settings["settle_tolerance"] = float(object_map["inputSettleTolerance"].text())
+        settings["settle_timeout"] = float(object_map["inputSettleTimeout"].text())
+    except ValueError as e:
+        print("Failed to load settle settings", e)
+
     return settings
 
-def linkButtons(fnStart, fnAuto, fnCalibrate):
+def linkButtons(fnStart, fnAuto, fnCalibrate, fnReanalyse, fnResume):
     pysides.object_map["btnHome"].clicked.connect(goHome)
     pysides.object_map["btnFaraday"].clicked.connect(goFaraday)
     pysides.object_map["btnAuto"].clicked.connect(fnAuto)
     pysides.object_map["btnStart"].clicked.connect(fnStart)
     pysides.object_map["btnCalibrate"].clicked.connect(fnCalibrate)
     pysides.object_map["btnAbort"].clicked.connect(goAbort)
+    pysides.object_map["btnReanalyse"].clicked.connect(fnReanalyse)
+    pysides.object_map["btnResumeScan"].clicked.connect(fnResume)
+
+# switch positions from the last calibration, saved with each scan
+def getCalibration():
+    return {"home": pysides.auto_Home, "faraday": pysides.auto_Faraday, "end": pysides.auto_End}
+
+# the selected saved file if it can be resumed, otherwise the newest unfinished scan
+def getResumableFile():
+    resumable = scan_engine.find_resumable(pysides.results_dir)
+    selected = pysides.object_map["comboBoxFiles"].currentData()
+    if selected:
+        selected = os.path.join(pysides.results_dir, selected)
+        if selected in resumable:
+            return selected
+    return resumable[0] if resumable else None
 
 class WorkerSignals(QObject):
     finished = Signal()
     error = Signal(int) #status
     progress = Signal(int, int, float) #position, status, input voltage
+    row = Signal(int, int, object, object) #row index, number of rows, readings, online estimate
+    connection = Signal(bool, str) #connected, message
 
 
 class Worker(QRunnable):
@@ -146,29 +181,63 @@ class MainWindow(QMainWindow):
     position = 0
     status = 0
     voltage = 0
+    calibrationSnapshot = None  # status snapshot read by worker_calibrate
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         settings = self.loadSettings()
-        mc.setup(settings["address"])
+        self.statusSignals = WorkerSignals()
+        # timeouts, retries and keepalive of the controller link, see motor_control_galil
+        mc.configure_connection(settings)
+        mc.set_connection_listener(self.publish_connection)
+        with phase("controller setup"):
+            mc.setup(settings["address"])
+        if "statusTTL" in settings:
+            mc.set_status_ttl(settings["statusTTL"])
         pysides.results_dir = settings["saveLocation"]
 
+        # the I/O thread owns the controller from here on and publishes
+        # a status snapshot every 100 ms through statusSignals.progress
+        self.statusSignals.progress.connect(self.status_update)
+        mc.start_io_thread(self.publish_status, 0.1)
+
 
         self.setWindowTitle("IONSID Emittance Scanning")
-        self.setCentralWidget(pysides.getMainFrame())
-        linkButtons(self.startMeasurementWorker, self.startAutoMeasurementWorker, self.startCalibrationWorker)
+        with phase("main frame"):
+            self.setCentralWidget(pysides.getMainFrame())
+        pysides.updateConnectionState(mc.is_connected(), "")
+        self.statusSignals.connection.connect(pysides.updateConnectionState)
+        linkButtons(self.startMeasurementWorker, self.startAutoMeasurementWorker, self.startCalibrationWorker,
+                    self.startReanalysisWorker, self.startResumeWorker)
 
-        self.show()
+        # rows of the running scan go to the live view as they are saved
+        self.statusSignals.row.connect(pysides.updateLiveView)
+        scan_engine.row_listener = self.publish_row
+
+        # the timing panel only reads copies of the counters, no controller calls
+        self.metricsTimer = QTimer(self)
+        self.metricsTimer.timeout.connect(self.update_metrics)
+        self.metricsTimer.start(1000)
+
+        with phase("show"):
+            self.show()
 
         self.threadpool = QThreadPool()
         print("Multithreading with maximum %d threads" % self.threadpool.maxThreadCount())
 
-        self.timer = QTimer()
-        self.timer.setInterval(100)
-        self.timer.timeout.connect(self.recurring_timer)
-        self.timer.start()
-        
-        self.doneCalibration()
+        # scan buttons stay off until the worker has checked whether the motor stands at a switch
+        self.updateCalibratedButtons()
+        worker = Worker(self.worker_calibrate, False)
+        worker.signals.finished.connect(self.doneCalibration)
+        self.threadpool.start(worker)
+
+        # matplotlib and scipy are only needed for the first analysis, load them once the
+        # window has been drawn
+        QTimer.singleShot(0, self.window_ready)
+
+    def window_ready(self):
+        startup_timing.report()
+        plot_view.start_warm_up()
 
     def loadSettings(self):
         print(properties_file_path)
@@ -201,6 +270,24 @@ class MainWindow(QMainWindow):
         # Execute
         self.threadpool.start(worker)
 
+    def startResumeWorker(self):
+        filename = getResumableFile()
+        if filename is None:
+            print("No unfinished scan to resume")
+            return
+        pysides.object_map["inputFile"].setText(os.path.basename(filename))
+        worker = Worker(self.worker_resume, filename)
+        worker.signals.finished.connect(self.doneMeasurement)
+
+        pysides.object_map["lblStart"].setStyleSheet("background-color: orange")
+        pysides.object_map["lblStart"].setText("Resuming Scan")
+
+        # Execute
+        self.threadpool.start(worker)
+
+    def worker_resume(self, filename, progress_callback):
+        scan_engine.resume_scan(filename, getCalibration())
+
     def startCalibrationWorker(self):
         worker = Worker(self.worker_calibrate)
         worker.signals.finished.connect(self.doneCalibration)
@@ -208,9 +295,32 @@ class MainWindow(QMainWindow):
         # Execute
         self.threadpool.start(worker)
 
+    def startReanalysisWorker(self):
+        sigma, cut = pysides.getAnalysisParameters()
+        worker = Worker(self.worker_reanalyse, sigma, cut)
+        worker.signals.finished.connect(self.doneReanalysis)
+        pysides.object_map["btnReanalyse"].setEnabled(False)
+
+        # Execute
+        self.threadpool.start(worker)
+
+    # reanalyse every scan in the results directory with a process pool
+    def worker_reanalyse(self, sigma, cut, progress_callback):
+        output = os.path.join(pysides.results_dir, "analysis_summary.csv")
+        scan_catalog.refresh(pysides.results_dir)
+        summaries = batch_analysis.analyse_directory(pysides.results_dir, sigma, cut, output,
+            callback=lambda summary: print(summary["file"], summary["emittance"] if not summary["error"] else summary["error"]))
+        for summary in summaries:
+            if not summary["error"]:
+                scan_catalog.record_result(pysides.results_dir, summary["file"], summary)
+        print(len(summaries), "files reanalysed, summary written to", output)
+
+    def doneReanalysis(self):
+        pysides.object_map["btnReanalyse"].setEnabled(True)
+        pysides.populateListOfFiles()
+
     def doneMeasurement(self):
-        global currentOutputVoltage
-        currentOutputVoltage = 0
+        scan_engine.output_voltage = 0
         global running
         running = False
         
@@ -219,134 +329,103 @@ class MainWindow(QMainWindow):
         pysides.object_map["lblAuto"].setText("Initiate Auto Scan")
         pysides.object_map["lblStart"].setText("Initiate Custom Scan")
         
+        # the motor heads back to the Faraday cup while the file is analysed
+        mc.submit(mc.set_output_voltage, 0)
+        mc.submit(mc.move_to_position, pysides.auto_Faraday, speed=200000, final_speed=50000)
+
+        # the analysis adds the new file to the catalog and the list
         pysides.runFile()
         print("MEASUREMENT COMPLETE")
-        
-        mc.set_speed(200000)
-        mc.set_output_voltage(0)
-        mc.move_to_position(pysides.auto_Faraday)
-        mc.set_speed(50000)
-
-    # get current state from Galil, let main thread know so we can update UI
-    def worker_update(self, progress_callback):
-        global keepCheckingStatus
-        keepCheckingStatus = True
-        while keepCheckingStatus:
-            # position, status, input voltage
-            position = mc.get_position()
-            status = mc.check_status()
-            voltage = mc.get_analog_input()
-            try:
-                progress_callback.emit(position, status, voltage)
-            except RuntimeError:
-                return
-            time.sleep(0.1)
-        keepCheckingStatus = False
+
+    # called on the I/O thread, hand the snapshot over to the GUI thread
+    def publish_status(self, snapshot):
+        try:
+            self.statusSignals.progress.emit(snapshot["position"], snapshot["status"], snapshot["analog_input"])
+        except RuntimeError:
+            pass    # window already closed
+
+    def update_metrics(self):
+        pysides.updateMetricsPanel(mc.get_command_stats(), scan_engine.row_timings)
+
+    # called on the I/O thread when the controller link goes down or comes back
+    def publish_connection(self, connected, message):
+        try:
+            self.statusSignals.connection.emit(connected, message)
+        except RuntimeError:
+            pass    # window already closed
+
+    # called on the scan thread, the signal hands the row to the GUI thread
+    def publish_row(self, scan, index, row, estimate):
+        try:
+            self.statusSignals.row.emit(index, scan["motor_num_steps"], row, estimate)
+        except RuntimeError:
+            pass    # window already closed
 
     # check each voltage at each position step using the given ranges and step sizes
     def do_measurement(self, startMotor, endMotor, stepsMotor,
-                       startVoltage, endVoltage, stepsVoltage):
-        global running
-        running = True
-        global currentOutputVoltage
-        global currentPosition
-
-        while running:
-            try:
-                pysides.setFileName()
-                datafile = open(os.path.join(pysides.results_dir, object_map["inputFile"].text()), 'w')
-                print(object_map["inputFile"].text())
-
-                datafile.write(object_map["inputComment"].text() + "\n")
-                # Plate Length and Plate Gap (fixed)
-                datafile.write("40.78 4\n")
-                # Beam Energy
-                datafile.write(object_map["inputEnergy"].text() + "\n")
-                # Motor Start in mm
-                datafile.write(str(pysides.get_position_in_mm_raw(startMotor)) + "\n")
-                steps_to_mm = 196 / (pysides.auto_End - pysides.auto_Home)
-                print("steps to mm conversion is", steps_to_mm)
-                datafile.write(str(round((endMotor - startMotor) /stepsMotor * steps_to_mm, 4)) + "\n")
-                datafile.write(str(startVoltage) + "\n")
-                datafile.write(str(round((endVoltage - startVoltage) / stepsVoltage, 4)) + "\n")
-                datafile.write(str(stepsVoltage) + "\n")
-                datafile.write(str(stepsMotor) + "\n")
-                
-                mc.set_speed(200000)
-
-                for pos in np.linspace(startMotor, endMotor, stepsMotor):
-                    if not running:
-                        return
-                    time.sleep(1)
-                    mc.move_to_position(pos)
-                    while mc.is_in_motion() and running:
-                        print(f"curr pos {currentPosition} ({pysides.get_position_in_mm(currentPosition)}), aiming for pos {pos} ({pysides.get_position_in_mm(pos)})")
-                        time.sleep(0.5)
-                    dataline = ""
-                    for currentOutputVoltage in np.linspace(startVoltage, endVoltage, stepsVoltage):
-                        if not running:
-                            return
-                        mc.set_output_voltage(round(currentOutputVoltage, 2))
-                        time.sleep(0.05)
-                        dataline += str(currentInputVoltage) + " "
-                        print(f"currently at {pos} ({pysides.get_position_in_mm(pos)}) and sending out {round(currentOutputVoltage, 2)} to read in {currentInputVoltage}")
-                    datafile.write(dataline + "\n")
-                datafile.close()
-                running = False
-            except RuntimeError as e:
-                print("Failed to execute measurement", e)
-                running = False
-                return
-            time.sleep(0.1)
+                       startVoltage, endVoltage, stepsVoltage, settings):
+        pysides.setFileName()
+        scan = {
+            "filename": os.path.join(pysides.results_dir, object_map["inputFile"].text()),
+            "comment": object_map["inputComment"].text(),
+            "energy": object_map["inputEnergy"].text(),
+            "motor_start_mm": pysides.get_position_in_mm_raw(startMotor),
+            "steps_to_mm": calibration.steps_to_mm(getCalibration()),
+            "start_motor": startMotor,
+            "end_motor": endMotor,
+            "motor_num_steps": stepsMotor,
+            "start_voltage": startVoltage,
+            "end_voltage": endVoltage,
+            "voltage_num_steps": stepsVoltage,
+            "controller_sweep": settings["controller_sweep"],
+            "fly_scan": settings["fly_scan"],
+            "settle": settings["settle"],
+            "serpentine": settings["serpentine"],
+            "adaptive": settings["adaptive"],
+            "binary": settings["binary"],
+            "estimate": True,
+            "early_stop": settings["early_stop"],
+            "calibration": getCalibration(),
+        }
+        for key in ["settle_tolerance", "settle_timeout"]:
+            if key in settings:
+                scan[key] = settings[key]
+        scan_engine.run_scan(scan)
             
-    def worker_calibrate(self, progress_callback):
+    # find_switch False only reads the switches where the motor stands
+    def worker_calibrate(self, find_switch=True, progress_callback=None):
         global running
         running = True
-        if (mc.check_forward_switch() or 
-            mc.check_home_switch() or 
-            mc.check_reverse_switch()):
-                print("already at limit switch")
-        else:
-            mc.find_edge()
-            inMotion = mc.is_in_motion()
-            
-            while inMotion:
-                inMotion = mc.is_in_motion()
-                time.sleep(0.1)
-        
+        if find_switch:
+            calibration.find_switch()
         running = False
+        # read here, a dead link would hold up doneCalibration on the GUI thread for call_timeout
+        # the motor is standing at a switch, a snapshot from the last poll is fine
+        try:
+            self.calibrationSnapshot = mc.get_status_snapshot(max_age=1.0)
+        except RuntimeError as e:
+            print("Unable to read the limit switches", e)
+            self.calibrationSnapshot = None
             
     def doneCalibration(self):
         global running
         running = False
 
-        if mc.check_reverse_switch():
-            pysides.auto_Home = mc.get_position()
-            pysides.auto_Faraday = pysides.auto_Home + 3679098
-            pysides.auto_End = pysides.auto_Faraday + 2578395
-            print("At reverse switch!")
-            pysides.calibrated = True 
-        
-        if mc.check_home_switch():
-            print("At home switch!")
-            pysides.auto_Faraday = mc.get_position()
-            pysides.auto_End = pysides.auto_Faraday + 2578395
-            pysides.auto_Home = pysides.auto_Faraday - 3679098
-            pysides.calibrated = True 
-        
-        if mc.check_forward_switch():
-            pysides.auto_End = mc.get_position()
-            pysides.auto_Faraday = pysides.auto_End - 2578395
-            pysides.auto_Home = pysides.auto_Faraday - 3679098
-            print("At forward switch!")
-            pysides.calibrated = True 
-            
+        switches = calibration.from_snapshot(self.calibrationSnapshot) if self.calibrationSnapshot else None
+        if switches:
+            pysides.auto_Home = switches["home"]
+            pysides.auto_Faraday = switches["faraday"]
+            pysides.auto_End = switches["end"]
+            pysides.calibrated = True
+        self.updateCalibratedButtons()
+        pysides.setup_default_values()
+
+    def updateCalibratedButtons(self):
         pysides.object_map["btnHome"].setEnabled(pysides.calibrated)
         pysides.object_map["btnFaraday"].setEnabled(pysides.calibrated)
         pysides.object_map["btnAuto"].setEnabled(pysides.calibrated)
         pysides.object_map["btnStart"].setEnabled(pysides.calibrated)
-        
-        pysides.setup_default_values()
+        pysides.object_map["btnResumeScan"].setEnabled(pysides.calibrated)
 
     # retrieve settings and kick off measurement with default settings
     def worker_auto_measurement(self, progress_callback):
@@ -358,7 +437,7 @@ class MainWindow(QMainWindow):
         endMotor = settings["end_auto_motor"]
         stepsMotor = settings["motor_auto_num_steps"]
         self.do_measurement(startMotor, endMotor, stepsMotor,
-                       startVoltage, endVoltage, stepsVoltage)
+                       startVoltage, endVoltage, stepsVoltage, settings)
 
     # retrieve settings and kick off measurement with custom settings
     def worker_measurement(self, progress_callback):
@@ -370,60 +449,65 @@ class MainWindow(QMainWindow):
         endMotor = settings["end_motor"]
         stepsMotor = settings["motor_num_steps"]
         self.do_measurement(startMotor, endMotor, stepsMotor,
-                       startVoltage, endVoltage, stepsVoltage)
+                       startVoltage, endVoltage, stepsVoltage, settings)
 
     # A lot of these printouts are for debugging
     # Feel free to remove them or otherwise modify this file as needed
     def print_output(self, position, status, inputVoltage):
         print("reading current position as", position, "status is", status)
-        if mc.check_forward_switch():
+        snapshot = mc.get_status_snapshot()
+        if snapshot["forward"]:
             print("at forward switch")
-        if mc.check_reverse_switch():
+        if snapshot["reverse"]:
             print("at reverse switch")
-        if mc.check_home_switch():
+        if snapshot["home"]:
             print("at home switch")
 
     def thread_complete(self):
         print("THREAD COMPLETE!")
 
-    def recurring_timer(self):
-        global currentOutputVoltage
+    @Slot(int, int, float)
+    def status_update(self, position, status, voltage):
         global currentPosition
         global currentStatus
         global currentInputVoltage
-        position = mc.get_position()
-        status = mc.check_status()
-        voltage = mc.get_analog_input()
+        # no controller calls here, the I/O thread sent us this reading
+        switches = mc.decode_status(status)
         
         currentPosition = position
         currentStatus = status
         currentInputVoltage = voltage
         
-        pysides.updateStatus(position, status, currentOutputVoltage, currentInputVoltage)
+        pysides.updateStatus(currentPosition, currentStatus, scan_engine.output_voltage, currentInputVoltage)
         # Note - Reverse Limit, Home, and Forward for the Galil correspond to
         # Home, Faraday, and End in our program, respectively
         # Also we changed Home to Park at the last minute
         # I'm only changing that in the UI side to avoid breaking anything
         pysides.updateLimitSwitchStates(
-            mc.check_reverse_switch(),
-            mc.check_home_switch(),
-            mc.check_forward_switch()
+            switches["reverse"],
+            switches["home"],
+            switches["forward"]
         )
 
-        return 1
-
     # Send stop signal to threads, clean up
     def closeEvent(self, event):
         global running
         running = False
-        global keepCheckingStatus
-        keepCheckingStatus = False
+        scan_engine.abort()
         self.threadpool.waitForDone(1000)
         time.sleep(0.5)
-        mc.cleanup()
+        try:
+            mc.cleanup()
+        except mc.ConnectionLost as e:
+            print("Unable to stop the controller", e)
+        mc.stop_io_thread()
         time.sleep(0.5)
 
 
-app = QApplication(sys.argv)
-window = MainWindow()
-app.exec()
+# the guard keeps worker processes (batch_analysis) from opening another window
+if __name__ == "__main__":
+    with phase("QApplication"):
+        app = QApplication(sys.argv)
+    with phase("main window"):
+        window = MainWindow()
+    app.exec()
@@ -0,0 +1,205 @@
+import argparse
+import socket
+import socketserver
+import threading
+import time
+
+# Galil over plain TCP
+# GalilTcp talks the controller's ASCII protocol over a socket and has the gclib methods
+# motor_control_galil uses (GOpen, GClose, GTimeout, GInfo, GCommand, GProgramDownload,
+# GArrayUpload), so setup("tcp://host:port") works without gclib installed
+# A command goes out terminated by a carriage return, the reply is any response text
+# followed by ':', or '?' if the controller rejected the command
+#
+# StandInServer is the other end for tests: it serves any connector (e.g.
+# motor_control_fake.SimulatedGalil) on a local port and can stall or drop its connections
+# to imitate a flaky link:
+#   python galil_tcp.py --port 23000     then use "tcp://127.0.0.1:23000" as the address
+
+SCHEME = "tcp://"
+DEFAULT_PORT = 23
+
+def parse_address(address):
+    address = address.split()[0]    # gclib style options after the address are ignored
+    if address.startswith(SCHEME):
+        address = address[len(SCHEME):]
+    host, _, port = address.partition(':')
+    return host, int(port) if port else DEFAULT_PORT
+
+class GalilTcp:
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self.address = None
+        self.sock = None
+
+    def GOpen(self, address):
+        self.GClose()
+        self.address = parse_address(address)
+        self.sock = socket.create_connection(self.address, self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def GClose(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+
+    def GTimeout(self, milliseconds):
+        self.timeout = milliseconds / 1000
+
+    def GInfo(self):
+        return "Galil over TCP, %s:%d" % self.address
+
+    # send text and read up to the ':' or '?' ending the reply, within self.timeout
+    def _exchange(self, text):
+        if self.sock is None:
+            raise ConnectionError("not connected")
+        deadline = time.monotonic() + self.timeout
+        reply = b""
+        try:
+            self.sock.sendall(text.encode() + b"\r")
+            while not reply.endswith((b":", b"?")):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("no reply from the controller within %.3f s" % self.timeout)
+                self.sock.settimeout(remaining)
+                data = self.sock.recv(4096)
+                if not data:
+                    raise ConnectionError("connection closed by the controller")
+                reply += data
+        except OSError:
+            # a late reply would be read as the answer to the next command
+            self.GClose()
+            raise
+        if reply.endswith(b"?"):
+            raise RuntimeError("question mark returned by controller")
+        return reply[:-1].decode().strip()
+
+    def GCommand(self, command):
+        return self._exchange(command)
+
+    def GProgramDownload(self, program, preprocessor=''):
+        self._exchange("DL\r" + program.replace("\n", "\r") + "\r\\")
+
+    def GArrayUpload(self, name, first, last):
+        return self._exchange("QU %s[],%d,%d,1" % (name, first, last))
+
+class _StandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections.add(self.request)
+        try:
+            download = None
+            for line in self._lines():
+                if download is not None:
+                    if line == "\\":
+                        reply = self._call(server.connector.GProgramDownload, "\r".join(download), '')
+                        download = None
+                    else:
+                        download.append(line)
+                        continue
+                elif line.upper() == "DL":
+                    download = []
+                    continue
+                elif line.upper().startswith("QU "):
+                    name, first, last = line[3:].split(',')[:3]
+                    reply = self._call(server.connector.GArrayUpload, name.replace('[]', '').strip(),
+                                       int(first), int(last))
+                else:
+                    reply = self._call(server.connector.GCommand, line)
+                server.stall()
+                self.request.sendall(reply)
+        except OSError:
+            pass
+        finally:
+            with server.lock:
+                server.connections.discard(self.request)
+
+    def _lines(self):
+        buffer = b""
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                return
+            buffer += data
+            *lines, buffer = buffer.split(b"\r")
+            for line in lines:
+                yield line.decode().strip()
+
+    def _call(self, fn, *args):
+        try:
+            response = fn(*args)
+        except RuntimeError:
+            return b"?"
+        if response:
+            return str(response).encode() + b"\r\n:"
+        return b":"
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, connector, host="127.0.0.1", port=0):
+        super().__init__((host, port), _StandInHandler)
+        self.connector = connector
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.stalled_until = 0.0
+        self.thread = None
+
+    @property
+    def address(self):
+        return SCHEME + "%s:%d" % self.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="galil-stand-in", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.drop_connections()
+        self.shutdown()
+        self.server_close()
+
+    # replies are held back for the next seconds, like a link that stops passing packets
+    def stall_for(self, seconds):
+        self.stalled_until = time.monotonic() + seconds
+
+    def stall(self):
+        delay = self.stalled_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    # close every client connection, like a cable pulled and plugged back in
+    def drop_connections(self):
+        with self.lock:
+            for connection in list(self.connections):
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.connections.clear()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a simulated Galil controller over TCP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=23000)
+    parser.add_argument("--latency", type=float, default=0.002)
+    parser.add_argument("--time-scale", type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    import motor_control_fake
+    simulator = motor_control_fake.install(args.latency, 0.0005, args.time_scale)
+    server = StandInServer(simulator, args.host, args.port)
+    print("serving", simulator.GInfo(), "on", server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import numpy as np
+
+from PySide6.QtCore import QRect, Slot
+from PySide6.QtGui import QColor, QImage, QPainter
+from PySide6.QtWidgets import QWidget
+
+# Live phase-space view
+# Shows a scan while it is acquired: every position row arrives through a signal
+# (see scan_engine.row_listener) and becomes one column of an 8-bit indexed image,
+# position to the right and voltage upwards. Only the new column is converted and
+# repainted, the whole image is redrawn only when the colour range has to grow
+
+# index 0 is for points not measured yet, 1-255 a dark blue to yellow ramp
+RAMP = np.array([[68, 1, 84], [59, 82, 139], [33, 145, 140], [94, 201, 98], [253, 231, 37]], dtype=float)
+RANGE_HEADROOM = 0.25   # extra range added when the colour range grows, so it rarely grows again
+
+def _color_table():
+    steps = np.linspace(0, len(RAMP) - 1, 255)
+    colors = np.array([np.interp(steps, np.arange(len(RAMP)), RAMP[:, k]) for k in range(3)]).T.astype(int)
+    return [0xFF202020] + [0xFF000000 | (r << 16) | (g << 8) | b for r, g, b in colors]
+
+COLOR_TABLE = _color_table()
+
+class PhaseSpaceView(QWidget):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setMinimumHeight(200)
+        self.values = None      # voltages x positions, top row is the highest voltage
+        self.pixels = None      # the image buffer, rows padded to 4 bytes
+        self.image = None
+        self.measured = None    # columns received so far
+        self.low = 0.0
+        self.high = 0.0
+        self.last = -1
+
+    def reset(self, positions, voltages):
+        self.values = np.zeros((voltages, positions))
+        self.pixels = np.zeros((voltages, -(-positions // 4) * 4), dtype=np.uint8)
+        self.image = QImage(self.pixels.data, positions, voltages, self.pixels.shape[1],
+                            QImage.Format.Format_Indexed8)
+        self.image.setColorTable(COLOR_TABLE)
+        self.measured = np.zeros(positions, dtype=bool)
+        self.low = np.inf
+        self.high = -np.inf
+        self.last = -1
+        self.update()
+
+    def to_pixels(self, values):
+        span = self.high - self.low
+        if span <= 0:
+            return np.full(values.shape, 1, dtype=np.uint8)
+        return (1 + np.clip((values - self.low) / span, 0, 1) * 254).astype(np.uint8)
+
+    # row is one position of a scan with positions rows, values in voltage order
+    @Slot(int, int, object)
+    def addRow(self, index, positions, row):
+        row = np.asarray(row, dtype=float)
+        # a new scan, or one with a different grid
+        if self.values is None or index <= self.last or self.values.shape != (len(row), positions):
+            self.reset(positions, len(row))
+        self.last = index
+        self.values[:, index] = row[::-1]
+        self.measured[index] = True
+
+        low, high = row.min(), row.max()
+        if low < self.low or high > self.high:
+            margin = (max(high, self.high) - min(low, self.low)) * RANGE_HEADROOM
+            self.low = min(low, self.low)
+            self.high = max(high, self.high) + margin
+            columns = np.nonzero(self.measured)[0]
+            self.pixels[:, columns] = self.to_pixels(self.values[:, columns])
+            self.update()
+        else:
+            self.pixels[:, index] = self.to_pixels(self.values[:, index])
+            self.update(self.column_rect(index))
+
+    # widget area covered by one position column
+    def column_rect(self, index):
+        positions = self.values.shape[1]
+        left = int(index * self.width() / positions)
+        right = int(np.ceil((index + 1) * self.width() / positions))
+        return QRect(left, 0, right - left + 1, self.height())
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        if self.image is None:
+            painter.fillRect(self.rect(), QColor(COLOR_TABLE[0]))
+        else:
+            painter.drawImage(self.rect(), self.image)
+        painter.end()
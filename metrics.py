@@ -0,0 +1,129 @@
+import json
+import os
+
+import motor_control_galil as mc
+
+# Scan metrics
+# Controller command latency histograms (motor_control_galil.get_command_stats) and the
+# per-row phase timings of a scan (scan_engine.row_timings), summarised for the live panel
+# and written next to each scan as <filename>.metrics.json and, in the Prometheus text
+# format, <filename>.metrics.prom
+# This file must not import PySide6
+
+JSON_SUFFIX = ".metrics.json"
+PROMETHEUS_SUFFIX = ".metrics.prom"
+PHASES = ["move", "motion_wait", "settle", "acquire", "write"]
+
+# the commands sent between two get_command_stats snapshots
+def subtract_stats(after, before):
+    difference = {}
+    for kind, stats in after.items():
+        earlier = before.get(kind)
+        if earlier is None:
+            difference[kind] = stats
+        elif stats["count"] > earlier["count"]:
+            difference[kind] = {
+                "count": stats["count"] - earlier["count"],
+                "sum": stats["sum"] - earlier["sum"],
+                "max": stats["max"],    # the largest since the first snapshot is not kept
+                "buckets": [a - b for a, b in zip(stats["buckets"], earlier["buckets"])],
+            }
+    return difference
+
+# upper bound of the bucket holding the q quantile, the largest call for the last bucket
+def percentile(stats, q):
+    if stats["count"] == 0:
+        return 0.0
+    needed = q * stats["count"]
+    total = 0
+    for bound, count in zip(mc.LATENCY_BUCKETS, stats["buckets"]):
+        total += count
+        if total >= needed:
+            return min(bound, stats["max"])
+    return stats["max"]
+
+def summarise_commands(command_stats):
+    return {kind: {
+        "count": stats["count"],
+        "total_s": stats["sum"],
+        "mean_s": stats["sum"] / stats["count"] if stats["count"] else 0.0,
+        "p50_s": percentile(stats, 0.5),
+        "p90_s": percentile(stats, 0.9),
+        "p99_s": percentile(stats, 0.99),
+        "max_s": stats["max"],
+    } for kind, stats in command_stats.items()}
+
+# seconds spent in each phase over all rows
+def phase_totals(row_timings):
+    totals = {phase: 0.0 for phase in PHASES}
+    for timing in row_timings:
+        for phase in PHASES:
+            totals[phase] += timing.get(phase, 0.0)
+    return totals
+
+def _label(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+def prometheus_text(command_stats, row_timings, scan_name):
+    scan_label = "scan=" + _label(scan_name)
+    lines = [
+        "# HELP galil_command_latency_seconds Controller call latency by command type",
+        "# TYPE galil_command_latency_seconds histogram",
+    ]
+    for kind in sorted(command_stats):
+        stats = command_stats[kind]
+        labels = scan_label + ",command=" + _label(kind)
+        total = 0
+        for bound, count in zip(list(mc.LATENCY_BUCKETS) + ["+Inf"], stats["buckets"]):
+            total += count
+            lines.append(f"galil_command_latency_seconds_bucket{{{labels},le=\"{bound}\"}} {total}")
+        lines.append(f"galil_command_latency_seconds_sum{{{labels}}} {stats['sum']:.6f}")
+        lines.append(f"galil_command_latency_seconds_count{{{labels}}} {stats['count']}")
+    lines += [
+        "# HELP scan_phase_seconds_total Time spent in each phase of the scan rows",
+        "# TYPE scan_phase_seconds_total counter",
+    ]
+    for phase, seconds in phase_totals(row_timings).items():
+        lines.append(f"scan_phase_seconds_total{{{scan_label},phase=\"{phase}\"}} {seconds:.6f}")
+    lines += [
+        "# HELP scan_rows_total Rows written",
+        "# TYPE scan_rows_total counter",
+        f"scan_rows_total{{{scan_label}}} {len(row_timings)}",
+    ]
+    return "\n".join(lines) + "\n"
+
+# write both files next to the scan
+def write_scan_metrics(filename, command_stats, row_timings, duration):
+    name = os.path.basename(filename)
+    metrics = {
+        "scan": name,
+        "duration_s": duration,
+        "rows": len(row_timings),
+        "phases_s": phase_totals(row_timings),
+        "row_timings": row_timings,
+        "latency_buckets_s": list(mc.LATENCY_BUCKETS),
+        "commands": {kind: dict(stats, **summarise_commands({kind: stats})[kind])
+                     for kind, stats in command_stats.items()},
+    }
+    with open(filename + JSON_SUFFIX, 'w') as jsonfile:
+        json.dump(metrics, jsonfile, indent=1)
+    with open(filename + PROMETHEUS_SUFFIX, 'w') as promfile:
+        promfile.write(prometheus_text(command_stats, row_timings, name))
+
+# text for the live panel, the slowest command types by total time first
+def format_panel(command_stats, row_timings, limit=8):
+    lines = []
+    if row_timings:
+        last = row_timings[-1]
+        totals = phase_totals(row_timings)
+        lines.append(f"row {last['row'] + 1}: " +
+                     ", ".join(f"{phase} {last.get(phase, 0.0):.2f} s" for phase in PHASES))
+        lines.append(f"{len(row_timings)} rows: " +
+                     ", ".join(f"{phase} {totals[phase]:.1f} s" for phase in PHASES))
+    summary = summarise_commands(command_stats)
+    lines.append(f"{'command':<24}{'count':>8}{'mean ms':>10}{'p90 ms':>10}{'max ms':>10}")
+    for kind in sorted(summary, key=lambda k: -summary[k]["total_s"])[:limit]:
+        entry = summary[kind]
+        lines.append(f"{kind[:23]:<24}{entry['count']:>8}{1000 * entry['mean_s']:>10.2f}"
+                     f"{1000 * entry['p90_s']:>10.2f}{1000 * entry['max_s']:>10.2f}")
+    return "\n".join(lines)
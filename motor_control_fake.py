@@ -0,0 +1,346 @@
+import importlib
+import math
+import random
+import re
+import sys
+import threading
+import time as _time
+
+import calibration
+import motor_control_galil
+from motor_control_galil import *
+
+# Galil simulator
+# `import motor_control_fake as mc` gives the whole motor_control_galil API running against
+# SimulatedGalil instead of gclib, so the GUI and scan_engine can be exercised without hardware.
+# install() swaps in a new simulator with other settings, e.g. for benchmarks:
+#   sim = motor_control_fake.install(latency=0.003, jitter=0.001, time_scale=20)
+#
+# The simulator models
+#   motion         trapezoidal PA moves with the SP/AC/DC settings, ST decelerates, AB stops at once
+#   switches       reverse limit at reverse_position, home at + calibration.FARADAY_OFFSET, forward
+#                  limit at + calibration.END_OFFSET from there, the offsets calibration assumes;
+#                  FE/BG moves to home
+#   analog input   a correlated Gaussian beam in (motor position, AO2) plus background and noise,
+#                  AO2 reaches the beam with a first order lag so settling takes time
+#   sweep program  XQ #SWEEP,1 runs in a thread like program thread 1, HX1 stops it
+#   latency        every call takes latency + |gauss(0, jitter)| seconds
+# With time_scale > 1 simulated time runs that many times faster than real time: install()
+# gives motor_control_galil and scan_engine a ScaledClock as their time module
+
+HOME_WIDTH = 500        # counts either side of home where the home input is active
+
+# beam centred at 175 mm of the 193 mm travel, like the auto scan range
+DEFAULT_BEAM = {
+    "position": round(175 / calibration.TRAVEL_MM * (calibration.FARADAY_OFFSET + calibration.END_OFFSET)),
+    "position_width": 100000,   # counts
+    "voltage": 0.0,             # AO2 volts
+    "voltage_width": 0.5,
+    "correlation": 0.3,
+    "amplitude": 1.0,           # volts at @AN[1]
+    "background": 0.01,
+    "noise": 0.001,
+    "response_time": 0.01,      # seconds, AO2 to beam first order lag
+}
+
+# Stand-in for the time module with simulated time running factor times faster
+class ScaledClock:
+    def __init__(self, factor=1.0):
+        self.factor = float(factor)
+        self.real_origin = _time.monotonic()
+        self.wall_origin = _time.time()
+
+    def monotonic(self):
+        return self.real_origin + (_time.monotonic() - self.real_origin) * self.factor
+
+    def perf_counter(self):
+        return self.monotonic()
+
+    def time(self):
+        return self.wall_origin + (self.monotonic() - self.real_origin)
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            _time.sleep(seconds / self.factor)
+
+    def __getattr__(self, name):
+        return getattr(_time, name)
+
+class SimulatedGalil:
+    def __init__(self, latency=0.002, jitter=0.0005, clock=None, beam=None, reverse_position=0,
+                 start_position=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.clock = clock or ScaledClock(1.0)
+        self.beam = dict(DEFAULT_BEAM, **(beam or {}))
+        self.reverse_limit = reverse_position
+        self.home_position = reverse_position + calibration.FARADAY_OFFSET
+        self.forward_limit = self.home_position + calibration.END_OFFSET
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.speed = 25000
+        self.acceleration = 256000
+        self.deceleration = 256000
+        self.segments = []          # motion profile: (start time, position, velocity, acceleration, duration)
+        self.position = float(self.home_position if start_position is None else start_position)
+        self.pending = None         # target of the next BG
+        self.output = 0.0           # AO2 set point
+        self.beam_output = 0.0      # AO2 as seen by the beam
+        self.output_time = self.clock.monotonic()
+        self.variables = {}
+        self.arrays = {}
+        self.program = None
+        self.sweep_thread = None
+        self.sweep_stop = threading.Event()
+        self.commands = 0
+
+    # gclib calls
+    def GOpen(self, address):
+        self._wait()
+
+    def GClose(self):
+        self.sweep_stop.set()
+
+    def GInfo(self):
+        return "SimulatedGalil, latency %.4f s, jitter %.4f s, time x%g" % (self.latency, self.jitter, self.clock.factor)
+
+    def GProgramDownload(self, program, preprocessor=''):
+        self._wait()
+        self.program = program
+
+    def GArrayUpload(self, name, first, last):
+        self._wait()
+        with self.lock:
+            if name not in self.arrays:
+                raise RuntimeError("question mark returned by controller")
+            return ", ".join("%.4f" % value for value in self.arrays[name][first:last + 1])
+
+    def GCommand(self, packet):
+        self._wait()
+        responses = []
+        with self.lock:
+            for cmd in packet.split(';'):
+                cmd = cmd.strip()
+                if cmd:
+                    self.commands += 1
+                    response = self._command(cmd)
+                    if response is not None:
+                        responses.append(response)
+        return "\r\n".join(responses)
+
+    def _wait(self):
+        delay = self.latency + abs(self.random.gauss(0, self.jitter)) if self.jitter else self.latency
+        self.clock.sleep(delay)
+
+    def _command(self, cmd):
+        upper = cmd.upper()
+        if upper.startswith('MG '):
+            return " " + " ".join("%.4f" % self._operand(item.strip()) for item in cmd[3:].split(','))
+        if upper in ('TP', 'RP'):
+            return "%d" % round(self._motion_state()[0])
+        if upper == 'TS':
+            return "%d" % self._status_word()
+        for name, attribute in [('SP', 'speed'), ('AC', 'acceleration'), ('DC', 'deceleration')]:
+            if upper.startswith(name) and re.match(r'^-?[\d.]+$', cmd[2:]):
+                setattr(self, attribute, abs(float(cmd[2:])))
+                return None
+        if upper.startswith('PA'):
+            self.pending = float(cmd[2:])
+        elif upper.startswith('PR'):
+            self.pending = self._motion_state()[0] + float(cmd[2:])
+        elif upper == 'FE':
+            self.pending = float(self.home_position)
+        elif upper == 'BG':
+            # like the controller, BG is rejected while the axis is still moving
+            if self._moving():
+                raise RuntimeError("question mark returned by controller")
+            if self.pending is not None:
+                self._plan_move(self.pending)
+                self.pending = None
+        elif upper == 'ST':
+            self._plan_stop()
+            self._halt_sweep()
+        elif upper == 'AB':
+            self._set_still(self._motion_state()[0])
+            self._halt_sweep()
+        elif upper.startswith('AO2,'):
+            self._set_output(float(cmd[4:]))
+        elif upper.startswith('DM '):
+            match = re.match(r'DM (\w+)\[(\d+)\]', cmd)
+            self.arrays[match.group(1)] = [0.0] * int(match.group(2))
+        elif upper.startswith('DA '):
+            name = cmd[3:].split('[')[0].strip()
+            if name not in self.arrays:
+                raise RuntimeError("question mark returned by controller")
+            del self.arrays[name]
+        elif upper.startswith('XQ #SWEEP'):
+            self._start_sweep()
+        elif upper.startswith('HX'):
+            self._halt_sweep()
+        elif re.match(r'^\w+=', cmd):
+            name, value = cmd.split('=', 1)
+            self.variables[name.strip()] = float(value)
+        # CN, MO, SH and anything else are accepted and ignored
+        return None
+
+    def _operand(self, item):
+        upper = item.upper()
+        if upper in ('_RPA', '_TPA'):
+            return round(self._motion_state()[0])
+        if upper == '_TSA':
+            return self._status_word()
+        if upper == '@AN[1]':
+            return self._reading()
+        if upper == '_BGA':
+            return 1 if self._moving() else 0
+        if upper == '_XQ1':
+            return 0 if self.sweep_thread is not None and self.sweep_thread.is_alive() else -1
+        if item in self.variables:
+            return self.variables[item]
+        raise RuntimeError("question mark returned by controller")
+
+    # Motion
+    # the profile is a list of constant acceleration segments from the last BG, ST or AB
+    def _motion_state(self):
+        now = self.clock.monotonic()
+        for start, position, velocity, acceleration, duration in self.segments:
+            if now < start + duration:
+                t = now - start
+                return position + velocity * t + acceleration * t * t / 2, velocity + acceleration * t
+        if self.segments:
+            start, position, velocity, acceleration, duration = self.segments[-1]
+            self.position = position + velocity * duration + acceleration * duration * duration / 2
+            self.segments = []
+        return self.position, 0.0
+
+    def _moving(self):
+        return bool(self.segments) and self.clock.monotonic() < self.segments[-1][0] + self.segments[-1][4]
+
+    def _set_still(self, position):
+        self.position = position
+        self.segments = []
+
+    def _plan_move(self, target):
+        position, velocity = self._motion_state()
+        # motion stops at a limit switch
+        target = min(max(target, self.reverse_limit), self.forward_limit)
+        distance = abs(target - position)
+        if distance == 0:
+            self._set_still(position)
+            return
+        direction = 1 if target > position else -1
+        accel = self.acceleration or 1.0
+        decel = self.deceleration or 1.0
+        speed = self.speed or 1.0
+        accel_distance = speed * speed / (2 * accel)
+        decel_distance = speed * speed / (2 * decel)
+        if accel_distance + decel_distance > distance:
+            # triangular profile, never reaches speed
+            speed = math.sqrt(2 * distance * accel * decel / (accel + decel))
+            accel_distance = speed * speed / (2 * accel)
+            decel_distance = distance - accel_distance
+        cruise_time = (distance - accel_distance - decel_distance) / speed
+        now = self.clock.monotonic()
+        accel_time = speed / accel
+        decel_time = speed / decel
+        cruise_start = position + direction * accel_distance
+        decel_start = target - direction * decel_distance
+        self.segments = [
+            (now, position, 0.0, direction * accel, accel_time),
+            (now + accel_time, cruise_start, direction * speed, 0.0, cruise_time),
+            (now + accel_time + cruise_time, decel_start, direction * speed, -direction * decel, decel_time),
+        ]
+        self.position = target
+
+    def _plan_stop(self):
+        position, velocity = self._motion_state()
+        if velocity == 0:
+            self._set_still(position)
+            return
+        decel = self.deceleration or 1.0
+        duration = abs(velocity) / decel
+        self.segments = [(self.clock.monotonic(), position, velocity, -math.copysign(decel, velocity), duration)]
+        self.position = position + velocity * duration / 2
+
+    def _status_word(self):
+        position = self._motion_state()[0]
+        status = 0
+        if abs(position - self.home_position) <= HOME_WIDTH:
+            status |= 2
+        if position > self.reverse_limit:
+            status |= 4     # bit set while the reverse limit is not active
+        if position < self.forward_limit:
+            status |= 8     # bit set while the forward limit is not active
+        if self._moving():
+            status |= 128
+        return status
+
+    # Analog input
+    def _set_output(self, voltage):
+        self.beam_output = self._effective_output()
+        self.output = voltage
+        self.output_time = self.clock.monotonic()
+
+    def _effective_output(self):
+        tau = self.beam["response_time"]
+        if tau <= 0:
+            return self.output
+        elapsed = self.clock.monotonic() - self.output_time
+        return self.output + (self.beam_output - self.output) * math.exp(-elapsed / tau)
+
+    def _reading(self):
+        beam = self.beam
+        u = (self._motion_state()[0] - beam["position"]) / beam["position_width"]
+        v = (self._effective_output() - beam["voltage"]) / beam["voltage_width"]
+        rho = beam["correlation"]
+        signal = beam["amplitude"] * math.exp(-(u * u - 2 * rho * u * v + v * v) / (2 * (1 - rho * rho)))
+        return signal + beam["background"] + self.random.gauss(0, beam["noise"])
+
+    # Sweep program (thread 1)
+    def _start_sweep(self):
+        self._halt_sweep()
+        self.sweep_stop = threading.Event()
+        self.sweep_thread = threading.Thread(target=self._run_sweep, args=(self.sweep_stop,), daemon=True)
+        self.sweep_thread.start()
+
+    def _halt_sweep(self):
+        # no join, the caller holds the lock the sweep thread needs to notice the stop
+        if self.sweep_thread is not None:
+            self.sweep_stop.set()
+            self.sweep_thread = None
+
+    def _run_sweep(self, stop):
+        count = int(self.variables.get('swn', 0))
+        self.variables['swi'] = 0
+        for k in range(count):
+            with self.lock:
+                if stop.is_set():
+                    return
+                self._set_output(self.variables['swv0'] + k * self.variables['swdv'])
+            self.clock.sleep(self.variables.get('swwt', 0) / 1000)
+            with self.lock:
+                if stop.is_set():
+                    return
+                self.arrays['swin'][k] = self._reading()
+                self.arrays['swpos'][k] = round(self._motion_state()[0])
+                self.variables['swi'] = k + 1
+
+simulator = None
+_time_modules = ("motor_control_galil", "scan_engine")
+
+# Install a new simulator as the controller connection, returns it
+# time_scale > 1 runs simulated time faster, settings go to SimulatedGalil
+def install(latency=0.002, jitter=0.0005, time_scale=1.0, **settings):
+    global simulator, galil_connector
+    clock = ScaledClock(time_scale)
+    for name in _time_modules:
+        # only modules already loaded need their real time module back
+        module = importlib.import_module(name) if time_scale != 1 else sys.modules.get(name)
+        if module is not None:
+            module.time = clock if time_scale != 1 else _time
+    simulator = SimulatedGalil(latency, jitter, clock, **settings)
+    motor_control_galil.use_connector(simulator)
+    galil_connector = simulator
+    return simulator
+
+install()
@@ -1,25 +1,548 @@
 from ast import Try
 from re import S
-import gclib
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import bisect
+import itertools
+import queue
+import threading
 import time
 
-galil_connector = gclib.py()
+import galil_tcp
 
+try:
+    import gclib
+except ImportError:
+    gclib = None    # no Galil driver here, use a tcp:// address or install a simulator with use_connector
+
+galil_connector = gclib.py() if gclib else None
+
+# Position, status word and analog input are read together with one MG command
+# and cached for status_ttl seconds, so the UI timer and the scan worker share
+# one reading instead of each sending their own TS/RP/@AN queries
+status_ttl = 0.05
+_status_snapshot = None
+_status_generation = 0
+_status_lock = threading.Lock()
+
+# Several commands can be joined with ';' into one packet, which costs a single
+# network round trip. Packets must stay within the controller's line limit
+MAX_PACKET_LENGTH = 80
+# Commands that print a response; used to split a joined response back apart
+RESPONSE_COMMANDS = ('MG', 'TS', 'RP', 'TP', 'TE', 'TV')
+
+# On-controller voltage sweep, runs in program thread 1
+# Steps AO2 from swv0 in swdv increments, waits swwt ms at each step and
+# records @AN[1] into swin[] and the motor position into swpos[], so a whole
+# row costs one array upload
+SWEEP_MAX_STEPS = 1000
+# operand used to tag sweep samples with the motor position; RP matches the
+# units used everywhere else, use _TPA on axes with an encoder in the same units
+position_operand = '_RPA'
+SWEEP_PROGRAM = "\r".join([
+    "#SWEEP",
+    "swi=0",
+    "#SWSTEP",
+    "AO2,swv0+(swi*swdv)",
+    "WT swwt",
+    "swin[swi]=@AN[1]",
+    "swpos[swi]=" + position_operand,
+    "swi=swi+1",
+    "JP#SWSTEP,swi<swn",
+    "EN",
+])
+_sweep_loaded = False
+SWEEP_POLL = 0.05           # how often a running sweep checks keep_going
+
+# Command latency
+# Every controller call is timed on the thread that runs it and counted into a histogram
+# per command type ("PA+BG", "MG _RPA", "GArrayUpload", ...). Buckets are log spaced upper
+# bounds in seconds, the extra last bucket counts everything slower. Recording a call is a
+# bisect and a few additions under a lock, get_command_stats hands out a copy
+LATENCY_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+                   0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+_command_stats = {}
+_stats_lock = threading.Lock()
+
+def command_type(cmd):
+    kinds = []
+    for c in cmd.split(';'):
+        c = c.strip()
+        if c == "":
+            continue
+        if c[:2].upper() == 'MG':
+            kinds.append(c.split(',')[0])   # the first operand tells status, analog and thread reads apart
+        elif '=' in c:
+            kinds.append(c.split('=')[0].strip() + '=')
+        else:
+            kinds.append(c[:2].upper())
+    return '+'.join(kinds)
+
+def record_latency(kind, seconds):
+    bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+    with _stats_lock:
+        stats = _command_stats.get(kind)
+        if stats is None:
+            stats = _command_stats[kind] = {"count": 0, "sum": 0.0, "max": 0.0,
+                                            "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+        stats["count"] += 1
+        stats["sum"] += seconds
+        stats["buckets"][bucket] += 1
+        if seconds > stats["max"]:
+            stats["max"] = seconds
+
+def get_command_stats():
+    with _stats_lock:
+        return {kind: dict(stats, buckets=list(stats["buckets"])) for kind, stats in _command_stats.items()}
+
+def reset_command_stats():
+    with _stats_lock:
+        _command_stats.clear()
+
+# Connection manager
+# Every controller call goes through _execute. The connection gets command_timeout as its
+# deadline (GTimeout), and when the link breaks the connection is opened again with the
+# address given to setup and the call is retried, at most command_retries times, if it is
+# safe to send twice. While the link is down calls fail at once with ConnectionLost, a new
+# connection is tried at most every reconnect_interval. A thread waiting for a queued call
+# gives up after call_timeout, so a dead link never freezes a caller
+# The idle I/O thread sends a keepalive probe every keepalive_interval and reconnects in
+# the background, connection_listener(connected, message) is told about every change
+command_timeout = 1.0
+command_retries = 2
+retry_delay = 0.02          # before the first retry, doubles with each one
+reconnect_interval = 1.0
+keepalive_interval = 2.0
+call_timeout = 10.0
+KEEPALIVE_COMMAND = 'MG _TPA'
+SETUP_COMMANDS = ['CN1,-1,1', 'SP10000', 'AC10000', 'DC10000']
+# sent on every reconnect: a power cycle puts the limit switch polarity back to the controller
+# default, and CN leaves the speeds alone
+RECONNECT_COMMANDS = ['CN1,-1,1']
+# commands that do the same thing when they arrive twice, a packet of only these (and
+# variable assignments) is retried after a reconnect. PR and FE move relative to wherever
+# the axis is and are never resent, the first one may have reached the controller before
+# the link went down
+RETRY_SAFE_COMMANDS = ('MG', 'TS', 'RP', 'TP', 'TE', 'TV', 'SP', 'AC', 'DC', 'PA', 'AO', 'ST', 'AB', 'CN', 'HX',
+                       'BG', 'XQ')
+# BG and XQ start something, a packet with them is only resent when the reconnected
+# controller shows it idle; running means the lost packet got through. Again after it
+# finished only repeats an absolute move to where the axis already is, or a sweep
+# properties.json keys for the settings above
+CONNECTION_PROPERTIES = {
+    "commandTimeout": "command_timeout",
+    "commandRetries": "command_retries",
+    "reconnectInterval": "reconnect_interval",
+    "keepaliveInterval": "keepalive_interval",
+    "callTimeout": "call_timeout",
+}
+connection_listener = None
+connected = False
+_configured = False         # SETUP_COMMANDS have been sent to this connector's controller
+_address = None
+_last_contact = 0.0
+_next_reconnect = 0.0
+
+class ConnectionLost(RuntimeError):
+    pass
+
+def configure_connection(properties):
+    for key, name in CONNECTION_PROPERTIES.items():
+        if key in properties:
+            value = properties[key]
+            globals()[name] = int(value) if name == "command_retries" else float(value)
+
+# use these rather than the module variables, a module that re-exports this one
+# (motor_control_fake) only has a copy of connection_listener and connected
+def set_connection_listener(listener):
+    global connection_listener
+    connection_listener = listener
+
+def is_connected():
+    return connected
+
+def _is_link_error(e):
+    if isinstance(e, OSError):
+        return True
+    # gclib reports rejected commands and broken links with the same exception type
+    return gclib is not None and isinstance(e, gclib.GclibError) and "question mark" not in str(e).lower()
+
+# runs on the I/O thread after a reconnect, for a GCommand packet whose reply was lost
+def _lost_packet_started(cmd):
+    for c in cmd.split(';'):
+        c = c.strip().upper()
+        if c[:2] == 'BG' and float(galil_connector.GCommand('MG _BGA')) > 0:
+            return True
+        if c[:2] == 'XQ':
+            thread = c.split(',')[1].strip() if ',' in c else '0'
+            if float(galil_connector.GCommand('MG _XQ' + thread)) >= 0:
+                return True
+    return False
+
+def _retry_safe(cmd):
+    for c in cmd.split(';'):
+        c = c.strip()
+        if c and '=' not in c and c[:2].upper() not in RETRY_SAFE_COMMANDS:
+            return False
+    return True
+
+def _set_connected(state, message):
+    global connected
+    if state == connected:
+        return
+    connected = state
+    print(message)
+    if connection_listener:
+        connection_listener(state, message)
+
+# runs on the I/O thread
+# SETUP_COMMANDS are only sent by the first successful open: the controller keeps its settings
+# while the link is down, and sending SP10000 again would slow every later move that relies
+# on the speed set before the outage. Later opens send RECONNECT_COMMANDS instead, the
+# link only counts as connected once the controller has answered
+def _open():
+    global _last_contact, _configured
+    galil_connector.GOpen(_address)
+    if hasattr(galil_connector, "GTimeout"):
+        galil_connector.GTimeout(int(command_timeout * 1000))
+    galil_connector.GCommand(';'.join(RECONNECT_COMMANDS if _configured else SETUP_COMMANDS))
+    _configured = True
+    _last_contact = time.monotonic()
+    _set_connected(True, "controller connected at " + str(_address))
+
+def _reconnect():
+    global _sweep_loaded, _next_reconnect
+    try:
+        galil_connector.GClose()
+    except Exception:
+        pass
+    # the controller may have been reset, load the sweep program again
+    _sweep_loaded = False
+    invalidate_status()
+    try:
+        _open()
+    except Exception:
+        _next_reconnect = time.monotonic() + reconnect_interval
+        raise
+
+# call a connector method on the I/O thread, see Connection manager above
+def _execute(kind, method, args, retry=True):
+    global _last_contact
+    attempts = command_retries + 1 if retry else 1
+    error = None
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(retry_delay * 2 ** (attempt - 1))
+        if not connected and _address is not None:
+            if time.monotonic() < _next_reconnect:
+                raise ConnectionLost("controller not connected" + (": " + repr(error) if error else ""))
+            try:
+                _reconnect()
+            except Exception as e:
+                if not _is_link_error(e):
+                    raise
+                error = e
+                continue
+        start = time.perf_counter()
+        try:
+            if error is not None and method == "GCommand" and _lost_packet_started(args[0]):
+                result = ""
+            else:
+                result = getattr(galil_connector, method)(*args)
+        except Exception as e:
+            if not _is_link_error(e):
+                raise
+            error = e
+            _set_connected(False, "controller link lost: " + repr(e))
+            continue
+        finally:
+            record_latency(kind, time.perf_counter() - start)
+        _last_contact = time.monotonic()
+        if not connected:
+            _set_connected(True, "controller connected")
+        return result
+    raise ConnectionLost(f"{kind} failed after {attempts} attempt(s): {error!r}")
+
+# keepalive probe when idle, reconnect while the link is down
+def _maintain_link():
+    if _address is None:
+        return
+    if not connected:
+        if time.monotonic() >= _next_reconnect:
+            try:
+                _reconnect()
+            except Exception as e:
+                if not _is_link_error(e):
+                    print(e)
+    elif time.monotonic() - _last_contact >= keepalive_interval:
+        try:
+            _execute(command_type(KEEPALIVE_COMMAND), "GCommand", (KEEPALIVE_COMMAND,), retry=False)
+        except ConnectionLost:
+            pass
+
+# I/O thread
+# Once started, one thread owns the gclib connection and runs every call from a queue,
+# so commands from the GUI and the scan worker can never interleave. Between calls it
+# keeps the status snapshot fresh and hands it to status_listener
+# Without the thread (e.g. in scripts) calls go straight to gclib
+status_listener = None
+status_poll_interval = 0.1
+_io_thread = None
+_io_queue = queue.PriorityQueue()
+_io_sequence = itertools.count()
+URGENT = 0      # queue priorities, urgent calls (abort) skip ahead of queued commands
+NORMAL = 1
+_STOP = 2
+
+def _on_io_thread():
+    return _io_thread is None or threading.current_thread() is _io_thread
+
+def submit(fn, *args, urgent=False, **kwargs):
+    # run fn on the I/O thread without waiting for it, returns a Future
+    future = Future()
+    if _on_io_thread():
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    _io_queue.put((URGENT if urgent else NORMAL, next(_io_sequence), future, fn, args, kwargs))
+    return future
+
+def _call(fn, *args):
+    if _on_io_thread():
+        return fn(*args)
+    future = submit(fn, *args)
+    try:
+        return future.result(timeout=call_timeout)
+    except FutureTimeout:
+        future.cancel()     # still queued, don't send it late
+        raise ConnectionLost(f"no answer from the controller within {call_timeout} s")
+
+def _publish_status():
+    # if another thread is already fetching a snapshot through the queue it is waiting
+    # on us (blocking on the lock would deadlock), publish the last reading instead
+    if not _status_lock.acquire(blocking=False):
+        snapshot = _status_snapshot
+        if snapshot is None:
+            return
+    else:
+        try:
+            snapshot = _read_status(status_ttl)
+        except Exception as e:
+            print(e)
+            return
+        finally:
+            _status_lock.release()
+    if status_listener:
+        status_listener(snapshot)
+
+def _io_loop():
+    next_poll = time.monotonic()
+    while True:
+        try:
+            item = _io_queue.get(timeout=max(next_poll - time.monotonic(), 0))
+        except queue.Empty:
+            item = None
+        if item is not None:
+            priority, sequence, future, fn, args, kwargs = item
+            if priority == _STOP:
+                return
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+        if time.monotonic() >= next_poll:
+            _maintain_link()
+            if connected or _address is None:
+                _publish_status()
+            next_poll = time.monotonic() + status_poll_interval
+
+def start_io_thread(listener=None, poll_interval=0.1):
+    global _io_thread, status_listener, status_poll_interval
+    if _io_thread is not None:
+        return
+    status_listener = listener
+    status_poll_interval = poll_interval
+    _io_thread = threading.Thread(target=_io_loop, name="galil-io", daemon=True)
+    _io_thread.start()
+
+def stop_io_thread():
+    # runs everything already queued, then stops
+    global _io_thread
+    if _io_thread is None:
+        return
+    thread = _io_thread
+    _io_queue.put((_STOP, next(_io_sequence), None, None, (), {}))
+    thread.join()
+    _io_thread = None
+
+def command(cmd):
+    return _call(_execute, command_type(cmd), "GCommand", (cmd,), _retry_safe(cmd))
+
+def _split_commands(commands):
+    split = []
+    for cmd in commands:
+        split += [c.strip() for c in cmd.split(';') if c.strip() != ""]
+    return split
+
+def _pack_commands(commands):
+    packets = []
+    packet = []
+    length = 0
+    for cmd in commands:
+        if packet and length + 1 + len(cmd) > MAX_PACKET_LENGTH:
+            packets.append(packet)
+            packet = []
+            length = 0
+        length += len(cmd) + (1 if packet else 0)
+        packet.append(cmd)
+    if packet:
+        packets.append(packet)
+    return packets
+
+def _split_responses(packet, response):
+    lines = [line.strip() for line in response.splitlines() if line.strip() != ""]
+    responses = []
+    for cmd in packet:
+        if cmd[:2].upper() in RESPONSE_COMMANDS and lines:
+            responses.append(lines.pop(0))
+        else:
+            responses.append("")
+    return responses
+
+def send_commands(commands):
+    # send a list of commands in as few packets as possible,
+    # returns one response string per command ("" if it prints nothing)
+    commands = _split_commands(commands)
+    responses = []
+    for packet in _pack_commands(commands):
+        responses += _split_responses(packet, command(';'.join(packet)))
+    return responses
+
+class CommandBatch:
+    # Collects commands and sends them together when the with block exits:
+    #   with mc.batch() as b:
+    #       b.add('SP200000')
+    #       index = b.add('MG _TPA')
+    #   b.responses[index]
+    def __init__(self):
+        self.commands = []
+        self.responses = []
+
+    def add(self, cmd):
+        self.commands.append(cmd)
+        return len(self.commands) - 1
+
+    def send(self):
+        self.responses = send_commands(self.commands)
+        self.commands = []
+        return self.responses
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.send()
+        return False
+
+def batch():
+    return CommandBatch()
+
+# Replace the gclib connection with anything that has the same methods
+# (GOpen, GInfo, GCommand, GProgramDownload, GArrayUpload), e.g. a simulator
+def use_connector(connector):
+    global galil_connector, _sweep_loaded, connected, _configured, _next_reconnect
+    galil_connector = connector
+    _sweep_loaded = False
+    _configured = False
+    # not opened yet, with an address from setup the next call opens it
+    connected = False
+    _next_reconnect = 0.0
+    invalidate_status()
+
+# open the connection, address is a gclib address or tcp://host:port (see galil_tcp.py)
+# A controller that can not be reached is reported through connection_listener and left to
+# the reconnect in _execute and on the I/O thread, setup does not raise for it
 def setup(address):
-    galil_connector.GOpen(address)
-    print(galil_connector.GInfo())
-    galil_connector.GCommand('CN1,-1,1')
-    galil_connector.GCommand('SP10000;AC10000;DC10000')
+    global _address, _next_reconnect
+    if address.startswith(galil_tcp.SCHEME):
+        use_connector(galil_tcp.GalilTcp())
+    _address = address
+    try:
+        _call(_open)
+    except Exception as e:
+        if not _is_link_error(e):
+            raise
+        _next_reconnect = time.monotonic() + reconnect_interval
+        message = "controller not reachable at " + str(address) + ": " + repr(e)
+        print(message)
+        if connection_listener:
+            connection_listener(False, message)
+        return
+    print(_call(galil_connector.GInfo))
 
 def find_edge():
-    galil_connector.GCommand('SP10000')
-    galil_connector.GCommand('FE;BG;')
+    send_commands(['SP10000', 'FE', 'BG'])
+    invalidate_status()
     time.sleep(0.1)
 
-def check_status():
+def set_status_ttl(seconds):
+    global status_ttl
+    status_ttl = float(seconds)
+
+def invalidate_status():
+    # drop the cached snapshot, e.g. after starting a move
+    # no lock here, this also runs on the I/O thread while another thread
+    # holds _status_lock waiting for it
+    global _status_snapshot, _status_generation
+    _status_generation += 1
+    _status_snapshot = None
+
+def decode_status(status_word):
+    # same bit meanings as the check_*_switch helpers below
+    return {
+        "home": bool(status_word & 2),
+        "reverse": not (status_word & 4),
+        "forward": not (status_word & 8),
+        "in_motion": bool(status_word & 128),
+    }
+
+def _read_status(max_age):
+    # call with _status_lock held
+    global _status_snapshot
+    snapshot = _status_snapshot
+    if snapshot is not None and time.monotonic() - snapshot["time"] <= max_age:
+        return snapshot
+    generation = _status_generation
+    values = command('MG _RPA, _TSA, @AN[1]').split()
+    status_word = int(float(values[1]))
+    snapshot = {
+        "time": time.monotonic(),
+        "position": int(float(values[0])),
+        "status": status_word,
+        "analog_input": float(values[2]),
+    }
+    snapshot.update(decode_status(status_word))
+    # a move started while we were reading makes this snapshot stale
+    if generation == _status_generation:
+        _status_snapshot = snapshot
+    return snapshot
+
+def get_status_snapshot(max_age=None):
+    if max_age is None:
+        max_age = status_ttl
+    with _status_lock:
+        return _read_status(max_age)
+
+def check_status(max_age=None):
     status_word = 0
     try:
-        status_word = int(galil_connector.GCommand('TS'))
+        status_word = get_status_snapshot(max_age)["status"]
+    except ConnectionLost:
+        # -1 would read as every bit set, e.g. a motor that never stops moving
+        raise
     except Exception as e:
         print(e)
         return -1
@@ -48,27 +571,122 @@ def check_in_motion(status_word):
         return True
     return False
 
-def get_position():
-    return int(galil_connector.GCommand('RP'))
+def get_position(max_age=None):
+    return get_status_snapshot(max_age)["position"]
+
+def get_analog_input(max_age=None):
+    return get_status_snapshot(max_age)["analog_input"]
 
-def get_analog_input():
-    return float(galil_connector.GCommand('MG @AN[1]'))
+def read_analog_input():
+    # direct read, bypasses the status cache
+    return float(command('MG @AN[1]'))
+
+# Read @AN[1] every `interval` seconds until the last `window` readings agree within
+# `tolerance` volts and the input drifts by less than `tolerance` over `drift_time` at the
+# rate seen across the window, or until `timeout` seconds have passed. Nothing is accepted
+# before `min_dwell`. Back to back readings of a slowly rising input agree with each other
+# long before it has settled, the spacing and the slope limit keep them from passing
+# Returns the mean of the last readings, the time it took and whether it settled
+def settle_analog_input(tolerance=0.005, window=3, timeout=0.5, interval=0.01, min_dwell=0.02,
+                        drift_time=0.05):
+    start = time.monotonic()
+    readings = []
+    times = []
+    while True:
+        readings.append(read_analog_input())
+        times.append(time.monotonic())
+        recent = readings[-window:]
+        elapsed = times[-1] - start
+        if len(recent) == window and elapsed >= min_dwell and max(recent) - min(recent) <= tolerance:
+            span = times[-1] - times[-window]
+            slope = abs(recent[-1] - recent[0]) / span if span > 0 else 0.0
+            if slope * drift_time <= tolerance:
+                return sum(recent) / len(recent), elapsed, True
+        if elapsed >= timeout:
+            return sum(recent) / len(recent), elapsed, False
+        time.sleep(max(interval - (time.monotonic() - times[-1]), 0))
 
 def set_output_voltage(voltage):
-    galil_connector.GCommand('AO2,' + str(voltage))
+    command('AO2,' + str(voltage))
+    # the analog input follows the output, don't hand out an older reading
+    invalidate_status()
+
+def move_to_position(position, speed=None, final_speed=None):
+    # speed is set before the move starts, final_speed right after BG,
+    # all in one packet
+    with batch() as b:
+        if speed is not None:
+            b.add('SP' + str(speed))
+        b.add('PA' + str(position))
+        b.add('BG')
+        if final_speed is not None:
+            b.add('SP' + str(final_speed))
+    invalidate_status()
+
+def load_sweep_program():
+    global _sweep_loaded
+    _call(_execute, "GProgramDownload", "GProgramDownload", (SWEEP_PROGRAM, ''))
+    for array in ['swin', 'swpos']:
+        try:
+            command('DA ' + array + '[]')
+        except Exception:
+            pass    # array did not exist yet
+        command('DM ' + array + '[' + str(SWEEP_MAX_STEPS) + ']')
+    _sweep_loaded = True
+
+def _upload_array(name, count):
+    values = _call(_execute, "GArrayUpload", "GArrayUpload", (name, 0, count - 1))
+    if isinstance(values, str):
+        values = values.replace('\r', ',').replace('\n', ',').split(',')
+    return [float(v) for v in values if str(v).strip() != ""]
+
+def sweep_voltage(start, end, steps, dwell=0.05, with_positions=False, keep_going=None):
+    # step AO2 over np.linspace(start, end, steps) on the controller and
+    # return the @AN[1] reading taken dwell seconds after each step,
+    # with_positions also returns the motor position at each reading
+    # keep_going is checked while the sweep runs, when it returns False the sweep is
+    # halted; returns None if the program stopped before the last step (halted here or
+    # by an HX1 from elsewhere), swin[] past that point still holds the previous sweep
+    if steps > SWEEP_MAX_STEPS:
+        raise ValueError("at most " + str(SWEEP_MAX_STEPS) + " voltage steps per sweep")
+    if not _sweep_loaded:
+        load_sweep_program()
+    step = (end - start) / (steps - 1) if steps > 1 else 0
+    send_commands(['swv0=' + str(start), 'swdv=' + str(step), 'swn=' + str(steps),
+                   'swwt=' + str(int(round(dwell * 1000))), 'XQ #SWEEP,1'])
+    # no controller traffic until the sweep should be done, only keep_going is checked
+    finish = time.monotonic() + steps * dwell
+    while time.monotonic() < finish:
+        if keep_going and not keep_going():
+            stop_sweep()
+            break
+        time.sleep(min(SWEEP_POLL, max(finish - time.monotonic(), 0)))
+    while True:
+        thread, recorded = [float(v) for v in command('MG _XQ1, swi').split()]
+        if thread < 0:
+            break
+        if keep_going and not keep_going():
+            stop_sweep()
+        time.sleep(0.01)
+    invalidate_status()
+    if recorded < steps:
+        return None
+    values = _upload_array('swin', steps)
+    if with_positions:
+        return values, _upload_array('swpos', steps)
+    return values
 
-def move_to_position(position):
-    galil_connector.GCommand('PA' + str(position))
-    galil_connector.GCommand('BG')
+def stop_sweep():
+    command('HX1')
 
 def set_speed(velocity):
-    galil_connector.GCommand('SP' + str(velocity))
+    command('SP' + str(velocity))
 
 def stop_motor():
     # stop the motor
-    galil_connector.GCommand('ST;AB;')
+    command('ST;AB;')
+    invalidate_status()
     
 def cleanup():
-    stop_motor()
-    set_speed(100000)
-    set_output_voltage(0)
+    send_commands(['ST', 'AB', 'SP100000', 'AO2,0'])
+    invalidate_status()
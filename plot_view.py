@@ -0,0 +1,121 @@
+import threading
+import time
+import traceback
+from os import path
+
+import numpy as np
+
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Qt, Signal, Slot
+from PySide6.QtGui import QImage, QPixmap
+from PySide6.QtWidgets import QLabel, QSizePolicy
+
+import analysis_cache
+import do_contour
+import scan_catalog
+
+# Embedded analysis plot
+# The analysis and the drawing run on a thread pool worker, the GUI thread only gets the
+# finished image, so no plt.show event loop runs in the GUI process. There is one Agg figure
+# for all renders, it is cleared and redrawn instead of creating a new figure every time
+# matplotlib is only imported when the figure is first needed, warm_up does that (and loads
+# the analysis modules) on a background thread once the window is up
+
+DPI = 100
+
+_figure = None
+_canvas = None
+_render_lock = threading.Lock()     # the figure is shared, one render at a time
+
+# call with _render_lock held
+def _get_figure():
+    global _figure, _canvas
+    if _figure is None:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        _figure = Figure(dpi=DPI, facecolor='w', edgecolor='k')
+        _canvas = FigureCanvasAgg(_figure)
+    return _figure
+
+# import the plotting and filtering modules and create the figure ahead of the first analysis
+def warm_up():
+    start = time.perf_counter()
+    import scipy.ndimage
+    with _render_lock:
+        _get_figure()
+    print(f"analysis modules loaded in the background in {time.perf_counter() - start:.2f} s")
+
+def start_warm_up():
+    threading.Thread(target=warm_up, name="analysis-warm-up", daemon=True).start()
+
+# draw a do_contour.analyse result at width x height pixels, returns a QImage
+def render(result, width, height):
+    with _render_lock:
+        _get_figure()
+        _figure.clf()
+        _figure.set_size_inches(max(width, 100) / DPI, max(height, 100) / DPI)
+        do_contour.plot(result, ax=_figure.add_subplot())
+        _canvas.draw()
+        pixels = np.asarray(_canvas.buffer_rgba())
+        # copy, the canvas buffer is reused by the next render
+        return QImage(pixels.data, pixels.shape[1], pixels.shape[0], pixels.strides[0],
+                      QImage.Format.Format_RGBA8888).copy()
+
+class AnalysisSignals(QObject):
+    finished = Signal(str, object, QImage) # file name, result, rendered plot
+    error = Signal(str, str) # file name, message
+
+# analyse one file of results_dir (through the cache), update the catalog and render it
+class AnalysisTask(QRunnable):
+    def __init__(self, results_dir, filename, sigma, cut, width, height, signals):
+        super().__init__()
+        self.results_dir = results_dir
+        self.filename = filename
+        self.sigma = sigma
+        self.cut = cut
+        self.width = width
+        self.height = height
+        self.signals = signals
+
+    @Slot()
+    def run(self):
+        try:
+            result = analysis_cache.cached_analyse(path.join(self.results_dir, self.filename),
+                                                   self.sigma, self.cut,
+                                                   analysis_cache.cache_dir_for(self.results_dir))
+            do_contour.print_summary(result)
+            try:
+                scan_catalog.refresh(self.results_dir)
+                scan_catalog.record_result(self.results_dir, self.filename, result)
+            except Exception as e:
+                print("Unable to update scan catalog", e)
+            image = render(result, self.width, self.height)
+            self.signals.finished.emit(self.filename, result, image)
+        except Exception as e:
+            traceback.print_exc()
+            self.signals.error.emit(self.filename, repr(e))
+
+# Shows the last rendered analysis, show_file starts the analysis of another one
+class AnalysisView(QLabel):
+    def __init__(self, parent=None):
+        super().__init__("No analysis yet", parent)
+        self.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.setMinimumSize(300, 300)
+        self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
+        self.signals = AnalysisSignals()
+        self.signals.finished.connect(self.showImage)
+        self.signals.error.connect(self.showError)
+        self.pool = QThreadPool.globalInstance()
+
+    def show_file(self, results_dir, filename, sigma=0.6, cut=0.3):
+        self.setToolTip("Analysing " + filename)
+        self.pool.start(AnalysisTask(results_dir, filename, sigma, cut,
+                                     self.width(), self.height(), self.signals))
+
+    @Slot(str, object, QImage)
+    def showImage(self, filename, result, image):
+        self.setPixmap(QPixmap.fromImage(image))
+        self.setToolTip(f"{filename}: emittance {result['emittance']:.1f}")
+
+    @Slot(str, str)
+    def showError(self, filename, message):
+        self.setText(f"Unable to analyse {filename}\n{message}")
@@ -1,12 +1,11 @@
 import sys
 import time
 
-from os import listdir, path
-
-from PySide6.QtCore import Qt, QMargins, Slot
-from PySide6.QtGui import QColor
+from PySide6.QtCore import Qt, QMargins, QObject, QRunnable, QThreadPool, Signal, Slot
+from PySide6.QtGui import QColor, QFontDatabase
 from PySide6.QtWidgets import (
     QApplication,
+    QCheckBox,
     QComboBox,
     QFrame,
     QLabel,
@@ -16,7 +15,12 @@ from PySide6.QtWidgets import (
     QHBoxLayout
 )
 
-import do_contour
+import calibration
+import live_view
+import metrics
+import plot_view
+import scan_catalog
+import scan_format
 
 results_dir = ""    # Set in emittance_scanner.py
 
@@ -65,14 +69,17 @@ def getAbortFrame():
     lbl1 = QLabel("Current Position: -")
     lbl2 = QLabel("Current Voltage Output: -")
     lbl3 = QLabel("Current Voltage Reading: -")
+    lbl4 = QLabel("Controller: -")
 
     object_map["statusPosition"] = lbl1
     object_map["statusVoltageOutput"] = lbl2
     object_map["statusVoltageInput"] = lbl3
+    object_map["statusConnection"] = lbl4
 
     pane.addWidget(lbl1)
     pane.addWidget(lbl2)
     pane.addWidget(lbl3)
+    pane.addWidget(lbl4)
 
     return frame
 
@@ -220,13 +227,54 @@ def generateEnergyRow():
 
     return energy_frame
 
+def getCheckBox(name, label, tooltip=""):
+    checkBox = QCheckBox(label)
+    checkBox.setToolTip(tooltip)
+    object_map[name] = checkBox
+    return checkBox
+
+# Optional acquisition modes, read in getMeasurementSettings
+def generateScanOptionsRow():
+    options_frame = getQFrame()
+    options_pane = QHBoxLayout()
+    options_pane.setAlignment(Qt.AlignmentFlag.AlignLeft)
+    options_frame.setLayout(options_pane)
+
+    options_pane.addWidget(QLabel("Scan Options:"))
+    options_pane.addWidget(getCheckBox("checkControllerSweep", "Controller voltage sweep",
+        "Run each voltage sweep as a program on the Galil and upload the row in one read"))
+    options_pane.addWidget(getCheckBox("checkFlyScan", "Fly scan",
+        "Keep the motor moving while the controller sweeps the voltage, samples are tagged with the motor position"))
+    # off by default until it has been checked against the fixed delays on the real detector
+    options_pane.addWidget(getCheckBox("checkSettle", "Adaptive settle",
+        "Read the input until it settles instead of waiting fixed delays, settle times are saved next to the data file"))
+    options_pane.addWidget(getCheckBox("checkSerpentine", "Serpentine sweep",
+        "Sweep every other row from the end voltage back to the start to avoid the big jump between rows"))
+    options_pane.addWidget(getCheckBox("checkAdaptive", "Adaptive region",
+        "Find the beam with a coarse pass first and only measure around it at full resolution"))
+    options_pane.addWidget(getCheckBox("checkEarlyStop", "Early stop",
+        "End a step scan once the beam has been passed and the online emittance estimate is stable, the rest is filled with background"))
+    options_pane.addWidget(getCheckBox("checkBinaryFile", "Binary file",
+        "Save the scan as a binary .scan file with per-point timestamps and encoder positions instead of .dat"))
+    options_pane.addWidget(QLabel("Settle tolerance (V):"))
+    object_map["inputSettleTolerance"] = getLineEdit()
+    object_map["inputSettleTolerance"].setText("0.005")
+    options_pane.addWidget(object_map["inputSettleTolerance"])
+    options_pane.addWidget(QLabel("Max settle (s):"))
+    object_map["inputSettleTimeout"] = getLineEdit()
+    object_map["inputSettleTimeout"].setText("0.5")
+    options_pane.addWidget(object_map["inputSettleTimeout"])
+
+    return options_frame
+
 def generateContourPlot():
     print("generating contour with data file", object_map["inputFile"].text())
-    do_contour.load_file(results_dir + object_map["inputFile"].text())
-    do_contour.run()
+    showAnalysis(object_map["inputFile"].text())
     
 def setFileName():
-    object_map["inputFile"].setText("datafile_" + time.strftime("%Y-%m-%d_%H-%M") + ".dat")
+    binary = "checkBinaryFile" in object_map and object_map["checkBinaryFile"].isChecked()
+    extension = scan_format.EXTENSION if binary else ".dat"
+    object_map["inputFile"].setText("datafile_" + time.strftime("%Y-%m-%d_%H-%M") + extension)
 
 def generateFileRow(lbl):
     comment_frame = getQFrame()
@@ -247,12 +295,38 @@ def generateFileRow(lbl):
 
     return comment_frame
 
+# The list comes from the scan catalog, filtering and sorting never opens the files
 def populateListOfFiles():
     comboBox = object_map["comboBoxFiles"]
-    files = listdir(results_dir)
-    for file in files:
-        if file[-4:] == ".dat":
-            comboBox.addItem(file)
+    comboBox.clear()
+    for entry in scan_catalog.query(results_dir, object_map["inputFileFilter"].text(),
+                                    object_map["comboBoxSort"].currentText()):
+        comboBox.addItem(scan_catalog.describe(entry), entry["filename"])
+
+class CatalogSignals(QObject):
+    refreshed = Signal()
+
+# brings the scan catalog up to date with the results directory, off the GUI thread
+class CatalogRefreshTask(QRunnable):
+    def __init__(self, results_dir, signals):
+        super().__init__()
+        self.results_dir = results_dir
+        self.signals = signals
+
+    @Slot()
+    def run(self):
+        try:
+            scan_catalog.refresh(self.results_dir)
+        except OSError as e:
+            print("Unable to read results directory", e)
+        self.signals.refreshed.emit()
+
+catalog_signals = None  # refreshed fills the list again, set up in generateSavedFilesRow
+
+# the list is filled again once the refresh is done
+@Slot()
+def refreshListOfFiles():
+    QThreadPool.globalInstance().start(CatalogRefreshTask(results_dir, catalog_signals))
 
 def generateSavedFilesRow():
     comment_frame = getQFrame()
@@ -264,17 +338,117 @@ def generateSavedFilesRow():
 
     comment_pane.addWidget(QLabel("Saved Files:"))
 
+    object_map["inputFileFilter"] = QLineEdit()
+    object_map["inputFileFilter"].setPlaceholderText("Filter")
+    object_map["inputFileFilter"].setFixedWidth(120)
+    object_map["comboBoxSort"] = QComboBox()
+    object_map["comboBoxSort"].addItems(list(scan_catalog.SORT_COLUMNS))
     object_map["comboBoxFiles"] = QComboBox()
+    object_map["comboBoxFiles"].setMinimumWidth(400)
+    # what the catalog already knows, then bring it up to date on a worker
+    global catalog_signals
+    catalog_signals = CatalogSignals()
+    catalog_signals.refreshed.connect(populateListOfFiles)
     populateListOfFiles()
+    refreshListOfFiles()
+    object_map["inputFileFilter"].textChanged.connect(populateListOfFiles)
+    object_map["comboBoxSort"].currentTextChanged.connect(populateListOfFiles)
 
+    comment_pane.addWidget(object_map["inputFileFilter"])
+    comment_pane.addWidget(object_map["comboBoxSort"])
     comment_pane.addWidget(object_map["comboBoxFiles"])
+    refreshButton = getButton("btnRefreshFiles", "Refresh")
+    refreshButton.clicked.connect(refreshListOfFiles)
+    comment_pane.addWidget(refreshButton)
     runButton = getButton("btnRunSavedFile", "Run")
     runButton.clicked.connect(runFileFromList)
 
     comment_pane.addWidget(runButton)
+    # linked in emittance_scanner.py, continues the selected scan (or the newest
+    # unfinished one) from its checkpoint
+    resumeButton = getButton("btnResumeScan", "Resume Scan")
+    resumeButton.setToolTip("Continue an aborted or interrupted scan from the first row that was not saved")
+    comment_pane.addWidget(resumeButton)
+
+    # analysis parameters, used by the Run buttons and by Reanalyse All
+    comment_pane.addWidget(QLabel("  Sigma:"))
+    object_map["inputSigma"] = getLineEdit()
+    object_map["inputSigma"].setText("0.6")
+    object_map["inputSigma"].setFixedWidth(50)
+    comment_pane.addWidget(object_map["inputSigma"])
+    comment_pane.addWidget(QLabel("  Cut:"))
+    object_map["inputCut"] = getLineEdit()
+    object_map["inputCut"].setText("0.3")
+    object_map["inputCut"].setFixedWidth(50)
+    comment_pane.addWidget(object_map["inputCut"])
+    # linked in emittance_scanner.py, runs on a worker
+    comment_pane.addWidget(getButton("btnReanalyse", "Reanalyse All"))
 
     return comment_frame
 
+# Phase space of the running scan, filled in by updateLiveView as rows arrive,
+# next to the analysis of the last file shown
+def generatePlotsRow():
+    plots_frame = getQFrame()
+    plots_pane = QHBoxLayout()
+    plots_frame.setLayout(plots_pane)
+
+    live_pane = QVBoxLayout()
+    object_map["lblLiveView"] = QLabel("Live phase space: no scan running")
+    live_pane.addWidget(object_map["lblLiveView"])
+    object_map["livePhaseSpace"] = live_view.PhaseSpaceView()
+    live_pane.addWidget(object_map["livePhaseSpace"])
+    plots_pane.addLayout(live_pane)
+
+    analysis_pane = QVBoxLayout()
+    object_map["lblAnalysis"] = QLabel("Analysis:")
+    analysis_pane.addWidget(object_map["lblAnalysis"])
+    object_map["analysisView"] = plot_view.AnalysisView()
+    # the analysis records its result in the catalog (and adds a new file), show it in the list
+    object_map["analysisView"].signals.finished.connect(lambda filename, result, image: populateListOfFiles())
+    object_map["analysisView"].signals.error.connect(lambda filename, message: refreshListOfFiles())
+    analysis_pane.addWidget(object_map["analysisView"])
+    plots_pane.addLayout(analysis_pane)
+
+    return plots_frame
+
+@Slot(int, int, object, object)
+def updateLiveView(index, positions, row, estimate):
+    object_map["livePhaseSpace"].addRow(index, positions, row)
+    text = f"Live phase space: row {index + 1}/{positions}, peak reading {round(max(row), 3)} V"
+    if estimate is not None and estimate["emittance"] == estimate["emittance"]:
+        text += f", provisional emittance {estimate['emittance']:.1f}"
+    object_map["lblLiveView"].setText(text)
+
+# Controller command latencies and the phase timings of the scan rows, see metrics.py
+def generateMetricsRow():
+    metrics_frame = getQFrame()
+    metrics_pane = QVBoxLayout()
+    metrics_frame.setLayout(metrics_pane)
+    object_map["lblMetrics"] = QLabel("Timing: no commands sent yet")
+    object_map["lblMetrics"].setFont(QFontDatabase.systemFont(QFontDatabase.SystemFont.FixedFont))
+    object_map["lblMetrics"].setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse)
+    metrics_pane.addWidget(object_map["lblMetrics"])
+    return metrics_frame
+
+def updateMetricsPanel(command_stats, row_timings):
+    if command_stats or row_timings:
+        object_map["lblMetrics"].setText(metrics.format_panel(command_stats, row_timings))
+
+# analyse a file in results_dir on a worker, reusing the cached result if the file and
+# parameters have not changed, and show it in the analysis view when it is done
+def showAnalysis(filename):
+    sigma, cut = getAnalysisParameters()
+    object_map["lblAnalysis"].setText("Analysis: " + filename)
+    object_map["analysisView"].show_file(results_dir, filename, sigma, cut)
+
+def getAnalysisParameters():
+    try:
+        return float(object_map["inputSigma"].text()), float(object_map["inputCut"].text())
+    except ValueError as e:
+        print("Invalid analysis parameters, using defaults", e)
+        return 0.6, 0.3
+
 def getMainFrame():
     mainFrame = getQFrame()
     layout = QVBoxLayout(mainFrame)
@@ -285,9 +459,12 @@ def getMainFrame():
     layout.addWidget(generateMotorOrVoltageFrame("Voltage"))
     layout.addWidget(generateCommentRow())
     layout.addWidget(generateEnergyRow())
+    layout.addWidget(generateScanOptionsRow())
     layout.addWidget(generateFileRow("File name"))
     #layout.addWidget(generateFileRow("Timestamp file name"))
     layout.addWidget(generateSavedFilesRow())
+    layout.addWidget(generatePlotsRow())
+    layout.addWidget(generateMetricsRow())
 
     setup_default_values()
 
@@ -304,9 +481,7 @@ def setup_default_values():
 def get_position_in_mm_raw(position):
     if auto_End == auto_Home:
         return f"UNCALIBRATED"
-    total_distance_in_steps = auto_End - auto_Home
-    percentage_travelled = (position - auto_Home) / total_distance_in_steps
-    return round(percentage_travelled * 193, 2)
+    return calibration.position_in_mm({"home": auto_Home, "end": auto_End}, position)
 
 def get_position_in_mm(position):
     convertedPos = get_position_in_mm_raw(position)
@@ -315,8 +490,7 @@ def get_position_in_mm(position):
     return convertedPos
     
 def get_position_from_mm(mm):
-    total_distance_in_steps = auto_End - auto_Home
-    return int((float(mm) / 193) * total_distance_in_steps + auto_Home)
+    return calibration.position_from_mm({"home": auto_Home, "end": auto_End}, mm)
 
 # Note: adding status here is useful if something goes wrong, but I'm removing it for release
 def updateStatus(position, status, voltageOutput, voltageInput):
@@ -324,6 +498,17 @@ def updateStatus(position, status, voltageOutput, voltageInput):
     object_map["statusVoltageOutput"].setText("Current Voltage Output: " + str(round(voltageOutput, 2)))
     object_map["statusVoltageInput"].setText("Current Voltage Reading: " + str(round(voltageInput, 2)))
 
+# the readings above stop updating while the link is down, this says why
+def updateConnectionState(connected, message):
+    label = object_map["statusConnection"]
+    if connected:
+        label.setStyleSheet("")
+        label.setText("Controller: connected")
+    else:
+        label.setStyleSheet("background-color: red")
+        label.setText("Controller: link lost, reconnecting")
+    label.setToolTip(message)
+
 # Initially we had a button to move to the End position
 # but we removed it cause we couldn't think of why that would be useful
 def updateLimitSwitchStates(atHome, atFaraday, atEnd):
@@ -352,11 +537,11 @@ def updateLimitSwitchStates(atHome, atFaraday, atEnd):
 
 @Slot()
 def runFile():
-    do_contour.load_file(path.join(results_dir, object_map["inputFile"].text()))
-    do_contour.run()
+    showAnalysis(object_map["inputFile"].text())
 
 @Slot()
 def runFileFromList():
     comboBox = object_map["comboBoxFiles"]
-    do_contour.load_file(path.join(results_dir + comboBox.currentText()))
-    do_contour.run()
+    if comboBox.currentData() is None:
+        return
+    showAnalysis(comboBox.currentData())
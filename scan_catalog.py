@@ -0,0 +1,118 @@
+import os
+import sqlite3
+
+import do_contour
+import scan_format
+
+# Scan catalog
+# SQLite index of the scans in a results directory with their header metadata and the
+# last known analysis result, so the file list can be filtered and sorted without
+# opening every file. refresh() only rereads files whose mtime or size changed, and of
+# those only the header. Results come from record_result when a file is analysed (after a
+# scan, in the plot view, which takes them from the analysis cache, or by a reanalysis),
+# refresh never hashes whole files to look them up
+
+CATALOG_NAME = "scan_catalog.sqlite"
+SCAN_EXTENSIONS = (".dat", scan_format.EXTENSION)
+
+COLUMNS = ["filename", "mtime", "size", "comment", "beam_energy", "position_steps",
+           "voltage_steps", "motor_start", "motor_step_size", "voltage_min",
+           "voltage_step_size", "emittance", "x2RMS", "theta2RMS", "error"]
+
+SORT_COLUMNS = {
+    "Newest": "mtime DESC",
+    "Oldest": "mtime ASC",
+    "Name": "filename ASC",
+    "Energy": "beam_energy ASC, mtime DESC",
+    "Emittance": "emittance IS NULL, emittance ASC",
+}
+
+def connect(results_dir):
+    connection = sqlite3.connect(os.path.join(results_dir, CATALOG_NAME))
+    connection.row_factory = sqlite3.Row
+    connection.execute("""CREATE TABLE IF NOT EXISTS scans (
+        filename TEXT PRIMARY KEY,
+        mtime REAL,
+        size INTEGER,
+        comment TEXT,
+        beam_energy REAL,
+        position_steps INTEGER,
+        voltage_steps INTEGER,
+        motor_start REAL,
+        motor_step_size REAL,
+        voltage_min REAL,
+        voltage_step_size REAL,
+        emittance REAL,
+        x2RMS REAL,
+        theta2RMS REAL,
+        error TEXT)""")
+    return connection
+
+def read_header(filename):
+    if scan_format.is_binary_scan(filename):
+        return scan_format.read_header(filename)
+    with open(filename, 'r') as scanfile:
+        lines = [scanfile.readline() for _ in range(do_contour.HEADER_LINES)]
+    return do_contour.parse_header(lines)
+
+def _entry(results_dir, name, info):
+    filename = os.path.join(results_dir, name)
+    entry = dict.fromkeys(COLUMNS)
+    entry.update({"filename": name, "mtime": info.st_mtime, "size": info.st_size, "error": ""})
+    try:
+        entry.update({key: value for key, value in read_header(filename).items() if key in entry})
+    except (OSError, ValueError, IndexError) as e:
+        entry["error"] = repr(e)
+    return entry
+
+# bring the catalog up to date with the directory, returns the number of files reread
+def refresh(results_dir, extensions=SCAN_EXTENSIONS):
+    with connect(results_dir) as connection:
+        known = {row["filename"]: (row["mtime"], row["size"])
+                 for row in connection.execute("SELECT filename, mtime, size FROM scans")}
+        present = set()
+        changed = []
+        for item in os.scandir(results_dir):
+            if not item.name.endswith(extensions) or not item.is_file():
+                continue
+            present.add(item.name)
+            info = item.stat()
+            if known.get(item.name) != (info.st_mtime, info.st_size):
+                changed.append(_entry(results_dir, item.name, info))
+        connection.executemany(
+            "INSERT OR REPLACE INTO scans (" + ", ".join(COLUMNS) + ") VALUES (" +
+            ", ".join("?" * len(COLUMNS)) + ")",
+            [[entry[column] for column in COLUMNS] for entry in changed])
+        connection.executemany("DELETE FROM scans WHERE filename = ?",
+                               [[name] for name in set(known) - present])
+    connection.close()
+    return len(changed)
+
+# store the result of an analysis of one file
+def record_result(results_dir, name, result):
+    with connect(results_dir) as connection:
+        connection.execute("UPDATE scans SET emittance = ?, x2RMS = ?, theta2RMS = ? WHERE filename = ?",
+                           [float(result["emittance"]), float(result["x2RMS"]),
+                            float(result["theta2RMS"]), name])
+    connection.close()
+
+# scans whose file name or comment contains text, as dicts
+def query(results_dir, text="", sort="Newest"):
+    order = SORT_COLUMNS.get(sort, SORT_COLUMNS["Newest"])
+    pattern = "%" + text + "%"
+    with connect(results_dir) as connection:
+        rows = connection.execute(
+            "SELECT * FROM scans WHERE filename LIKE ? OR comment LIKE ? ORDER BY " + order,
+            [pattern, pattern]).fetchall()
+    connection.close()
+    return [dict(row) for row in rows]
+
+def describe(entry):
+    text = entry["filename"]
+    if entry["comment"]:
+        text += "  |  " + entry["comment"]
+    if entry["beam_energy"] is not None:
+        text += f"  |  {entry['beam_energy']:g} V  |  {entry['position_steps']} x {entry['voltage_steps']}"
+    if entry["emittance"] is not None and entry["emittance"] == entry["emittance"]:
+        text += f"  |  emittance {entry['emittance']:.1f}"
+    return text
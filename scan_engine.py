@@ -0,0 +1,652 @@
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import do_contour
+import metrics
+import motor_control_galil as mc
+import scan_format
+
+# Scan engine
+# Runs a measurement described by a scan dict and writes the .dat (or binary .scan) file read by do_contour
+# This file must not import PySide6, the GUI (emittance_scanner.py) fills in the scan dict
+#
+# scan dict keys:
+#   filename, comment, energy            file name and header text
+#   motor_start_mm, steps_to_mm          calibration for the header
+#   start_motor, end_motor, motor_num_steps
+#   start_voltage, end_voltage, voltage_num_steps
+#   controller_sweep                     sweep AO2 in a program on the controller
+#   fly_scan                             keep the motor moving while sweeping
+#   settle                               wait for readings to settle instead of fixed delays
+#   settle_tolerance, settle_window, settle_timeout, settle_interval, settle_min_dwell
+#                                        (optional, see mc.settle_analog_input)
+#   serpentine                           sweep odd rows from end to start voltage
+#   adaptive                             coarse pass first, then full resolution only around the beam
+#   coarse_factor, roi_margin            (optional, see do_adaptive_measurement)
+#   binary                               write a scan_format .scan file with per-point timestamps
+#                                        and encoder positions instead of .dat
+#   estimate                             keep a do_contour.StreamingEmittance estimate while scanning
+#   early_stop                           step scan: stop once the beam has been passed and the estimate
+#                                        is stable, the rest of the grid is filled with the background
+#   early_stop_tolerance, early_stop_rows (optional, see StreamingEmittance.converged)
+#   calibration                          {"home", "faraday", "end"} motor positions of the switches,
+#                                        used to line a resumed scan up with a new calibration
+#
+# Every row is flushed and fsynced as soon as it is measured, and <filename>.checkpoint.json
+# records the scan dict and the number of rows on disk. The checkpoint is removed when a scan
+# completes, so an aborted or crashed scan can be continued with resume_scan
+#
+# Every row also records how long it spent in each phase (see metrics.PHASES) in row_timings,
+# and when the scan ends the phase timings and the controller command latencies of the scan
+# are written next to it by metrics.write_scan_metrics
+
+running = True
+output_voltage = 0      # last voltage sent to AO2, shown in the UI
+row_listener = None     # called as row_listener(scan, index, row, estimate) after each row is saved, from the scan thread
+                        # estimate is the StreamingEmittance.estimate dict, or None
+row_timings = []        # {"row", phase: seconds} for each row of the current scan
+
+SCAN_SPEED = 200000
+DWELL_TIME = 0.05       # wait after each AO2 step before reading @AN[1]
+FLY_SWEEPS_PER_STEP = 2 # fly scan: voltage sweeps per position step
+MOTION_POLL = 0.02      # adaptive settle: motion poll interval
+SETTLE_TOLERANCE = 0.005
+SETTLE_WINDOW = 3
+SETTLE_TIMEOUT = 0.5
+SETTLE_INTERVAL = 0.01  # adaptive settle: time between readings
+SETTLE_MIN_DWELL = 0.02 # adaptive settle: no reading is accepted sooner after the AO2 step
+EARLY_STOP_TOLERANCE = 0.02 # relative change of the online estimate allowed over the last rows
+EARLY_STOP_ROWS = 3     # rows without beam needed after the beam before stopping
+COARSE_FACTOR = 4       # adaptive scan: coarse pass uses every n-th position and voltage
+ROI_MARGIN = 1          # adaptive scan: coarse steps added around the beam footprint
+ROI_CUT = 0.3           # adaptive scan: beam threshold, same as the background cut in do_contour
+HEADER_LINES = 9        # lines written by write_header
+CHECKPOINT_SUFFIX = ".checkpoint.json"
+
+def abort():
+    global running
+    running = False
+
+def write_header(datafile, scan):
+    startMotor = scan["start_motor"]
+    endMotor = scan["end_motor"]
+    stepsMotor = scan["motor_num_steps"]
+    startVoltage = scan["start_voltage"]
+    endVoltage = scan["end_voltage"]
+    stepsVoltage = scan["voltage_num_steps"]
+
+    datafile.write(scan["comment"] + "\n")
+    # Plate Length and Plate Gap (fixed)
+    datafile.write("40.78 4\n")
+    # Beam Energy
+    datafile.write(str(scan["energy"]) + "\n")
+    # Motor Start in mm
+    datafile.write(str(scan["motor_start_mm"]) + "\n")
+    print("steps to mm conversion is", scan["steps_to_mm"])
+    datafile.write(str(round((endMotor - startMotor) /stepsMotor * scan["steps_to_mm"], 4)) + "\n")
+    datafile.write(str(startVoltage) + "\n")
+    datafile.write(str(round((endVoltage - startVoltage) / stepsVoltage, 4)) + "\n")
+    datafile.write(str(stepsVoltage) + "\n")
+    datafile.write(str(stepsMotor) + "\n")
+
+# The header written by write_header as the dict do_contour.parse_header returns
+def scan_header(scan):
+    return {
+        "comment": scan["comment"],
+        "plate_length": 40.78,
+        "plate_gap": 4.0,
+        "beam_energy": float(scan["energy"]),
+        "motor_start": float(scan["motor_start_mm"]),
+        "motor_step_size": round((scan["end_motor"] - scan["start_motor"]) / scan["motor_num_steps"] * scan["steps_to_mm"], 4),
+        "voltage_min": float(scan["start_voltage"]),
+        "voltage_step_size": round((scan["end_voltage"] - scan["start_voltage"]) / scan["voltage_num_steps"], 4),
+        "voltage_steps": int(scan["voltage_num_steps"]),
+        "position_steps": int(scan["motor_num_steps"]),
+    }
+
+# Checkpoints
+def checkpoint_path(filename):
+    return filename + CHECKPOINT_SUFFIX
+
+def write_checkpoint(scan, completed_rows, state=None):
+    checkpoint = {"scan": scan, "completed_rows": completed_rows, "time": time.time()}
+    checkpoint.update(state or {})
+    path = checkpoint_path(scan["filename"])
+    # replace the old checkpoint in one step so a crash never leaves half a file
+    handle, temporary = tempfile.mkstemp(suffix=".json", dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(handle, 'w') as checkpointfile:
+        json.dump(checkpoint, checkpointfile, indent=2, default=float)
+        checkpointfile.flush()
+        os.fsync(checkpointfile.fileno())
+    os.replace(temporary, path)
+
+def read_checkpoint(filename):
+    with open(checkpoint_path(filename)) as checkpointfile:
+        return json.load(checkpointfile)
+
+# scan files in directory that have a checkpoint, newest first
+def find_resumable(directory):
+    checkpoints = [os.path.join(directory, name) for name in os.listdir(directory)
+                   if name.endswith(CHECKPOINT_SUFFIX)]
+    checkpoints.sort(key=os.path.getmtime, reverse=True)
+    return [checkpoint[:-len(CHECKPOINT_SUFFIX)] for checkpoint in checkpoints]
+
+# Output files, rows are handed over in order as they are measured and are on disk
+# when write_row returns, followed by a new checkpoint
+# timestamps (time.time()) and positions (encoder counts) are per point, only the
+# binary format keeps them. state holds extra checkpoint entries (the adaptive scan's region)
+class ScanOutput:
+    samples = False
+
+    def __init__(self, scan, start_row=0):
+        self.scan = scan
+        self.rows = start_row
+        self.state = {}
+        self.estimator = None
+
+    # phases are the row's measurement timings, the time spent writing is added here
+    def write_row(self, row, timestamps=None, positions=None, phases=None):
+        start = time.perf_counter()
+        self.write(row, timestamps, positions)
+        self.rows += 1
+        self.checkpoint()
+        timing = {"row": self.rows - 1}
+        timing.update(phases or {})
+        timing["write"] = time.perf_counter() - start
+        row_timings.append(timing)
+        estimate = self.estimator.add_row(self.rows - 1, row) if self.estimator else None
+        if row_listener:
+            row_listener(self.scan, self.rows - 1, list(row), estimate)
+
+    def checkpoint(self):
+        write_checkpoint(self.scan, self.rows, self.state)
+
+    # the scan completed, nothing left to resume
+    def finish(self):
+        try:
+            os.remove(checkpoint_path(self.scan["filename"]))
+        except FileNotFoundError:
+            pass
+
+class DatWriter(ScanOutput):
+    def __init__(self, scan, start_row=0):
+        super().__init__(scan, start_row)
+        if start_row:
+            # drop a partly written last line, then append
+            rows, length = dat_rows(scan["filename"])
+            self.datafile = open(scan["filename"], 'r+')
+            self.datafile.truncate(length)
+            self.datafile.seek(length)
+        else:
+            self.datafile = open(scan["filename"], 'w')
+            write_header(self.datafile, scan)
+            self.sync()
+
+    def sync(self):
+        self.datafile.flush()
+        os.fsync(self.datafile.fileno())
+
+    def write(self, row, timestamps, positions):
+        write_row(self.datafile, row)
+        self.sync()
+
+    def close(self):
+        self.datafile.close()
+
+class BinaryWriter(ScanOutput):
+    samples = True
+
+    def __init__(self, scan, start_row=0):
+        super().__init__(scan, start_row)
+        self.writer = scan_format.ScanFileWriter(scan["filename"], scan_header(scan), resume=start_row > 0)
+
+    def write(self, row, timestamps, positions):
+        self.writer.write_row(self.rows, row, timestamps, positions)
+
+    def close(self):
+        self.writer.close()
+
+def open_output(scan, start_row=0):
+    if scan.get("binary"):
+        return BinaryWriter(scan, start_row)
+    return DatWriter(scan, start_row)
+
+# complete data rows in a .dat file and the length of the file up to the end of the last one
+def dat_rows(filename):
+    with open(filename, 'rb') as datafile:
+        lines = datafile.read().split(b"\n")[:-1]
+    return max(len(lines) - HEADER_LINES, 0), sum(len(line) + 1 for line in lines)
+
+# Serpentine ordering: every other sweep runs from the end voltage back to the start,
+# so the deflector never jumps across the whole range between rows
+# Rows are always handed back in canonical (start to end) order for the file
+def sweep_reversed(scan, index):
+    return bool(scan.get("serpentine")) and index % 2 == 1
+
+def write_row(datafile, row):
+    dataline = ""
+    for value in row:
+        dataline += str(value) + " "
+    datafile.write(dataline + "\n")
+
+def wait_for_motion(poll=0.5):
+    start = time.monotonic()
+    while mc.is_in_motion() and running:
+        time.sleep(poll)
+    return time.monotonic() - start
+
+def settle(scan):
+    return mc.settle_analog_input(scan.get("settle_tolerance", SETTLE_TOLERANCE),
+                                  scan.get("settle_window", SETTLE_WINDOW),
+                                  scan.get("settle_timeout", SETTLE_TIMEOUT),
+                                  scan.get("settle_interval", SETTLE_INTERVAL),
+                                  scan.get("settle_min_dwell", SETTLE_MIN_DWELL))
+
+# sweep the voltage at the current position, returns None if aborted
+# with adaptive settle the time each point took is appended to settle_times
+# if samples is a dict its "timestamps" and "positions" are set to the per-point values
+def measure_row(scan, settle_times=None, reverse=False, samples=None):
+    global output_voltage
+    startVoltage = scan["start_voltage"]
+    endVoltage = scan["end_voltage"]
+    stepsVoltage = scan["voltage_num_steps"]
+    if reverse:
+        startVoltage, endVoltage = endVoltage, startVoltage
+
+    if scan.get("controller_sweep"):
+        # the controller steps AO2 and records @AN[1] itself, one upload per row
+        sweep_start = time.time()
+        sweep = mc.sweep_voltage(startVoltage, endVoltage, stepsVoltage, DWELL_TIME,
+                                 with_positions=samples is not None, keep_going=lambda: running)
+        # an aborted sweep leaves the previous row's readings in the controller's array
+        if sweep is None or not running:
+            return None
+        if samples is None:
+            row = sweep
+        else:
+            row, positions = sweep
+            # the controller does not timestamp samples, spread them over the sweep
+            timestamps = list(np.linspace(sweep_start, time.time(), len(row)))
+            samples["timestamps"] = timestamps[::-1] if reverse else timestamps
+            samples["positions"] = positions[::-1] if reverse else positions
+        output_voltage = endVoltage
+        return row[::-1] if reverse else row
+
+    row = []
+    times = []
+    timestamps = []
+    position = mc.get_position() if samples is not None else None
+    for output_voltage in np.linspace(startVoltage, endVoltage, stepsVoltage):
+        if not running:
+            return None
+        mc.set_output_voltage(round(output_voltage, 2))
+        if scan.get("settle"):
+            value, settle_time, settled = settle(scan)
+            row.append(value)
+            times.append(settle_time)
+        else:
+            time.sleep(DWELL_TIME)
+            # a direct read, a cached snapshot may be from before the dwell
+            row.append(mc.read_analog_input())
+        timestamps.append(time.time())
+    if settle_times is not None:
+        settle_times += times[::-1] if reverse else times
+    if samples is not None:
+        samples["timestamps"] = timestamps[::-1] if reverse else timestamps
+        samples["positions"] = [position] * len(row)
+    return row[::-1] if reverse else row
+
+# move to pos and sweep the voltage there, returns the row and the time spent moving
+# phases gets the seconds spent sending the move, waiting for the motion to end, waiting
+# for readings to settle (fixed delays, adaptive settle or the controller's dwell) and
+# the rest of the sweep
+def move_and_measure(scan, pos, index, settle_times=None, samples=None, phases=None):
+    start = time.perf_counter()
+    if not scan.get("settle"):
+        time.sleep(1)
+    delay = time.perf_counter() - start
+    mc.move_to_position(pos)
+    moved = time.perf_counter()
+    motion_time = wait_for_motion(MOTION_POLL if scan.get("settle") else 0.5)
+    waited = time.perf_counter()
+    times = settle_times if settle_times is not None else []
+    row = measure_row(scan, times, sweep_reversed(scan, index), samples)
+    if phases is not None:
+        sweep = time.perf_counter() - waited
+        if scan.get("settle") and not scan.get("controller_sweep"):
+            settled = sum(times)
+        else:
+            settled = DWELL_TIME * scan["voltage_num_steps"]
+        settled = min(settled, sweep)
+        phases.update({"move": moved - start - delay, "motion_wait": waited - moved,
+                       "settle": delay + settled, "acquire": sweep - settled})
+    return row, motion_time
+
+# check each voltage at each position step using the given ranges and step sizes
+def do_step_measurement(scan, output):
+    mc.set_speed(SCAN_SPEED)
+
+    # with adaptive settle the time spent settling each point goes into a
+    # sidecar file with the same row layout as the data
+    adaptive = scan.get("settle") and not scan.get("controller_sweep")
+    settlefile = open(scan["filename"] + ".settle", 'a' if output.rows else 'w') if adaptive else None
+    try:
+        positions = np.linspace(scan["start_motor"], scan["end_motor"], scan["motor_num_steps"])
+        for index, pos in enumerate(positions):
+            if index < output.rows:
+                continue
+            if not running:
+                return False
+            settle_times = []
+            samples = {} if output.samples else None
+            phases = {}
+            row, motion_time = move_and_measure(scan, pos, index, settle_times, samples, phases)
+            if row is None:
+                return False
+            print(f"row {index + 1}/{len(positions)} at {pos}: max reading {max(row)}, "
+                  f"move {motion_time:.2f} s, settle {phases['settle']:.2f} s, acquire {phases['acquire']:.2f} s")
+            output.write_row(row, phases=phases, **(samples or {}))
+            if settlefile:
+                write_row(settlefile, [round(t, 4) for t in settle_times])
+                settlefile.flush()
+            if scan.get("early_stop") and output.estimator and output.estimator.converged(
+                    scan.get("early_stop_tolerance", EARLY_STOP_TOLERANCE),
+                    scan.get("early_stop_rows", EARLY_STOP_ROWS)):
+                print(f"beam passed and estimate stable after row {index + 1}/{len(positions)}, "
+                      f"emittance {output.estimator.history[-1]:.2f}, stopping early")
+                fill_rows(output, settlefile, len(positions), len(row))
+                break
+    finally:
+        if settlefile:
+            settlefile.close()
+    return True
+
+# rows after an early stop get the background level of the rows measured so far
+def fill_rows(output, settlefile, count, length):
+    while output.rows < count:
+        output.write_row([output.estimator.background] * length)
+        if settlefile:
+            write_row(settlefile, [0] * length)
+    if settlefile:
+        settlefile.flush()
+
+# Adaptive (two-pass) scan
+# A coarse pass over the whole range finds the beam footprint, then the full resolution
+# pass only measures inside that region plus a margin. Points outside the region are
+# filled with the background level of the coarse pass, so the file keeps the full grid
+
+# bounding box of the beam in a coarse grid (rows are positions), returns
+# (position_min, position_max, voltage_min, voltage_max, background) in physical units
+def find_roi(grid, positions, voltages, cut=ROI_CUT, margin=ROI_MARGIN):
+    grid = np.asarray(grid, dtype=float)
+    background = float(np.median(grid))
+    signal = grid - background
+    if signal.max() <= 0:
+        # nothing above background, keep the full range
+        return positions[0], positions[-1], voltages[0], voltages[-1], background
+    rows, columns = np.nonzero(signal >= cut * signal.max())
+    row_lo = max(rows.min() - margin, 0)
+    row_hi = min(rows.max() + margin, len(positions) - 1)
+    column_lo = max(columns.min() - margin, 0)
+    column_hi = min(columns.max() + margin, len(voltages) - 1)
+    return (positions[row_lo], positions[row_hi], voltages[column_lo], voltages[column_hi],
+            background)
+
+# first and last index of the evenly spaced values (upwards or downwards) covering lo to hi,
+# edges between two points go to the nearer one, so at least one index is always kept
+def roi_index_range(values, lo, hi):
+    count = len(values)
+    if count < 2 or values[-1] == values[0]:
+        return [0, count - 1]
+    ends = (np.array([lo, hi], dtype=float) - values[0]) / (values[-1] - values[0]) * (count - 1)
+    first, last = np.clip(np.rint(np.sort(ends)), 0, count - 1).astype(int)
+    return [int(first), int(last)]
+
+# coarse pass of an adaptive scan, kept in memory, returns the region as index ranges
+# into the full grid (first and last row and column) and the background level,
+# or None if aborted
+def find_scan_roi(scan, positions, voltages, factor):
+    coarse = dict(scan)
+    coarse["motor_num_steps"] = max(int(np.ceil(len(positions) / factor)), 2)
+    coarse["voltage_num_steps"] = max(int(np.ceil(len(voltages) / factor)), 2)
+    coarse_positions = np.linspace(scan["start_motor"], scan["end_motor"], coarse["motor_num_steps"])
+    coarse_voltages = np.linspace(scan["start_voltage"], scan["end_voltage"], coarse["voltage_num_steps"])
+    coarse_grid = []
+    for index, pos in enumerate(coarse_positions):
+        if not running:
+            return None
+        row, motion_time = move_and_measure(coarse, pos, index)
+        if row is None:
+            return None
+        print(f"coarse row {index + 1}/{len(coarse_positions)} at {pos}: max reading {max(row)}")
+        coarse_grid.append(row)
+
+    position_lo, position_hi, voltage_lo, voltage_hi, background = find_roi(
+        coarse_grid, coarse_positions, coarse_voltages, margin=scan.get("roi_margin", ROI_MARGIN))
+    return {"rows": roi_index_range(positions, position_lo, position_hi),
+            "columns": roi_index_range(voltages, voltage_lo, voltage_hi),
+            "background": background}
+
+def do_adaptive_measurement(scan, output):
+    global output_voltage
+    mc.set_speed(SCAN_SPEED)
+    factor = scan.get("coarse_factor", COARSE_FACTOR)
+
+    positions = np.linspace(scan["start_motor"], scan["end_motor"], scan["motor_num_steps"])
+    voltages = np.linspace(scan["start_voltage"], scan["end_voltage"], scan["voltage_num_steps"])
+
+    # a resumed scan reuses the region found before
+    if "roi" not in output.state:
+        output.state["roi"] = find_scan_roi(scan, positions, voltages, factor)
+        if output.state["roi"] is None:
+            return False
+        output.checkpoint()
+    roi = output.state["roi"]
+    in_positions = np.zeros(len(positions), dtype=bool)
+    in_positions[roi["rows"][0]:roi["rows"][1] + 1] = True
+    in_voltages = np.arange(roi["columns"][0], roi["columns"][1] + 1)
+    background = roi["background"]
+    print(f"region of interest: positions {positions[roi['rows'][0]]} - {positions[roi['rows'][1]]}, "
+          f"voltages {voltages[in_voltages[0]]} - {voltages[in_voltages[-1]]}, "
+          f"{in_positions.sum()} x {len(in_voltages)} of {len(positions)} x {len(voltages)} points")
+
+    # full resolution pass inside the region
+    fine = dict(scan)
+    fine["start_voltage"] = voltages[in_voltages[0]]
+    fine["end_voltage"] = voltages[in_voltages[-1]]
+    fine["voltage_num_steps"] = len(in_voltages)
+    # rows measured before a resume count for the serpentine order
+    measured = int(in_positions[:output.rows].sum())
+    for index, pos in enumerate(positions):
+        if index < output.rows:
+            continue
+        if not running:
+            return False
+        row = [background] * len(voltages)
+        # points filled with the background keep NaN timestamps and positions
+        timestamps = [np.nan] * len(voltages)
+        encoder = [np.nan] * len(voltages)
+        phases = {}
+        if in_positions[index]:
+            samples = {} if output.samples else None
+            values, motion_time = move_and_measure(fine, pos, measured, samples=samples, phases=phases)
+            if values is None:
+                return False
+            measured += 1
+            for k, value in zip(in_voltages, values):
+                row[k] = value
+            if samples:
+                for k, timestamp, position in zip(in_voltages, samples["timestamps"], samples["positions"]):
+                    timestamps[k] = timestamp
+                    encoder[k] = position
+            print(f"row {index + 1}/{len(positions)} at {pos}: max reading {max(values)}")
+        output.write_row(row, timestamps, encoder, phases)
+    output_voltage = fine["end_voltage"]
+    return True
+
+# Fly scan
+# The motor moves through the whole range at a constant speed while the controller
+# repeats voltage sweeps. Every sample is tagged with the motor position it was taken at,
+# then each voltage column is interpolated onto the same position grid a step scan uses
+def regrid_fly_scan(sweep_positions, sweep_values, grid_positions):
+    sweep_positions = np.asarray(sweep_positions, dtype=float)
+    sweep_values = np.asarray(sweep_values, dtype=float)
+    grid = np.zeros((len(grid_positions), sweep_values.shape[1]))
+    for k in range(sweep_values.shape[1]):
+        order = np.argsort(sweep_positions[:, k], kind="stable")
+        grid[:, k] = np.interp(grid_positions, sweep_positions[order, k], sweep_values[order, k])
+    return grid
+
+def fly_scan_speed(scan, sweep_time):
+    # one position step takes FLY_SWEEPS_PER_STEP sweeps
+    steps = max(scan["motor_num_steps"] - 1, 1)
+    step_distance = abs(scan["end_motor"] - scan["start_motor"]) / steps
+    return max(int(step_distance / (sweep_time * FLY_SWEEPS_PER_STEP)), 1)
+
+# one position-tagged controller sweep, in canonical order
+def fly_sweep(scan, reverse):
+    global output_voltage
+    startVoltage = scan["start_voltage"]
+    endVoltage = scan["end_voltage"]
+    if reverse:
+        startVoltage, endVoltage = endVoltage, startVoltage
+    sweep = mc.sweep_voltage(startVoltage, endVoltage, scan["voltage_num_steps"],
+                             DWELL_TIME, with_positions=True, keep_going=lambda: running)
+    if sweep is None:
+        return None, None
+    values, positions = sweep
+    output_voltage = endVoltage
+    if reverse:
+        return values[::-1], positions[::-1]
+    return values, positions
+
+def do_fly_measurement(scan, output):
+
+    mc.set_speed(SCAN_SPEED)
+    mc.move_to_position(scan["start_motor"])
+    wait_for_motion()
+    if not running:
+        return False
+
+    # the first sweep is taken standing still at the start and also times a sweep
+    sweep_positions = []
+    sweep_values = []
+    sweep_start = time.monotonic()
+    values, positions = fly_sweep(scan, False)
+    sweep_time = time.monotonic() - sweep_start
+    if values is None:
+        return False
+    sweep_values.append(values)
+    sweep_positions.append(positions)
+
+    speed = fly_scan_speed(scan, sweep_time)
+    print(f"fly scan: {sweep_time:.2f} s per sweep, moving at {speed} steps/s")
+    mc.move_to_position(scan["end_motor"], speed=speed)
+    # make sure the next status read sees the move
+    time.sleep(0.05)
+    while running:
+        moving = mc.is_in_motion()
+        values, positions = fly_sweep(scan, sweep_reversed(scan, len(sweep_values)))
+        if values is None:
+            # aborted, or the sweep was halted from elsewhere: the scan is incomplete
+            mc.stop_motor()
+            break
+        sweep_values.append(values)
+        sweep_positions.append(positions)
+        # one more sweep standing still at the end, then stop
+        if not moving:
+            break
+    mc.set_speed(SCAN_SPEED)
+    if not running or values is None:
+        return False
+
+    print(f"fly scan: {len(sweep_values)} sweeps")
+    grid_positions = np.linspace(scan["start_motor"], scan["end_motor"], scan["motor_num_steps"])
+    # regridded points have no single sample time, only the grid position is kept
+    for pos, row in zip(grid_positions, regrid_fly_scan(sweep_positions, sweep_values, grid_positions)):
+        output.write_row(row, positions=[pos] * len(row))
+    return True
+
+# Run a scan, returns True if it completed
+# start_row and state continue a scan from a checkpoint, see resume_scan
+def run_scan(scan, start_row=0, state=None):
+    global running, row_timings
+    running = True
+    print(scan["filename"])
+    row_timings = []
+    command_stats = mc.get_command_stats()
+    start = time.monotonic()
+
+    # a move still running (e.g. scan_scheduler.approach) has to end before the first PA;BG,
+    # the controller rejects BG on a moving axis
+    try:
+        wait_for_motion(0.1)
+    except RuntimeError as e:
+        print("Failed to execute measurement", e)
+        running = False
+    # aborted or failed before anything was written
+    if not running:
+        return False
+
+    output = open_output(scan, start_row)
+    output.state = dict(state or {})
+    output.checkpoint()
+    if scan.get("estimate") or scan.get("early_stop"):
+        output.estimator = do_contour.StreamingEmittance(scan_header(scan))
+        if start_row:
+            # rows saved before a resume
+            header, data = do_contour.read_scan(scan["filename"])
+            for index in range(start_row):
+                output.estimator.add_row(index, data[index])
+    try:
+        if scan.get("adaptive"):
+            completed = do_adaptive_measurement(scan, output)
+        elif scan.get("fly_scan"):
+            completed = do_fly_measurement(scan, output)
+        else:
+            completed = do_step_measurement(scan, output)
+    except RuntimeError as e:
+        print("Failed to execute measurement", e)
+        completed = False
+    finally:
+        output.close()
+        try:
+            metrics.write_scan_metrics(scan["filename"], metrics.subtract_stats(mc.get_command_stats(), command_stats),
+                                       row_timings, time.monotonic() - start)
+        except OSError as e:
+            print("Unable to write scan metrics", e)
+    if completed:
+        output.finish()
+    running = False
+    return completed
+
+# Continue the scan saved in filename from the first row that is not on disk
+# calibration is the current {"home", "faraday", "end"}, if the switches moved since the
+# scan started the motor range is shifted by the change of the home position
+def resume_scan(filename, calibration=None):
+    checkpoint = read_checkpoint(filename)
+    scan = checkpoint["scan"]
+    if scan.get("binary"):
+        start_row = checkpoint["completed_rows"]
+    else:
+        # the file is synced before the checkpoint, it may hold one row more
+        start_row = dat_rows(filename)[0]
+    state = {key: value for key, value in checkpoint.items()
+             if key not in ("scan", "completed_rows", "time")}
+    if scan.get("fly_scan") and not scan.get("adaptive"):
+        # a fly scan is one continuous move, it can only be started again
+        print("fly scan can not be resumed, starting again")
+        start_row = 0
+    if calibration and scan.get("calibration"):
+        offset = calibration["home"] - scan["calibration"]["home"]
+        if offset:
+            print("calibration changed, shifting the motor range by", offset)
+            scan["start_motor"] += offset
+            scan["end_motor"] += offset
+        scan["calibration"] = calibration
+    print(f"resuming {filename} at row {start_row + 1}/{scan['motor_num_steps']}")
+    return run_scan(scan, start_row, state)
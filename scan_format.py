@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+
+# Binary scan container (.scan)
+#
+#   8 bytes   magic b"EMSCAN01"
+#   8 bytes   length of the JSON descriptor, little endian
+#   JSON      {"header": {...the nine .dat header fields...},
+#              "arrays": {name: {"offset": ..., "dtype": "<f8", "shape": [positions, voltages]}}}
+#   padding   up to ALIGNMENT bytes
+#   arrays    contiguous, "grid" always, "timestamps" and "positions" (encoder position
+#             of every point) optional, NaN where a point was not measured
+#
+# Arrays are loaded with np.memmap, so opening a scan copies nothing. The header dict has
+# the same keys as do_contour.parse_header, .dat import and export keep the old format around
+
+MAGIC = b"EMSCAN01"
+EXTENSION = ".scan"
+ALIGNMENT = 64
+DTYPE = "<f8"
+EXTRA_ARRAYS = ["timestamps", "positions"]
+
+def is_binary_scan(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source[:len(MAGIC)]) == MAGIC
+    try:
+        with open(source, 'rb') as scanfile:
+            return scanfile.read(len(MAGIC)) == MAGIC
+    except (OSError, TypeError):
+        return False
+
+def _layout(header, shape, extras):
+    # descriptor with array offsets filled in, and the size of the whole file
+    arrays = {}
+    descriptor = {"header": header, "arrays": arrays}
+    names = ["grid"] + [name for name in EXTRA_ARRAYS if name in extras]
+    for name in names:
+        arrays[name] = {"offset": 0, "dtype": DTYPE, "shape": list(shape)}
+    # offsets depend on the descriptor length, which depends on the offsets
+    while True:
+        text = json.dumps(descriptor).encode()
+        offset = -(-(len(MAGIC) + 8 + len(text)) // ALIGNMENT) * ALIGNMENT
+        start = offset
+        for name in names:
+            arrays[name]["offset"] = offset
+            offset += int(np.prod(shape)) * np.dtype(DTYPE).itemsize
+        if json.dumps(descriptor).encode() == text:
+            return text, start, offset
+
+# Writes a scan row by row into a preallocated file, every row is flushed to disk
+# as soon as it is written. With resume the existing file is reopened as it is
+class ScanFileWriter:
+    def __init__(self, filename, header, extras=EXTRA_ARRAYS, resume=False):
+        if resume:
+            descriptor = _read_descriptor(filename)
+        else:
+            shape = (int(header["position_steps"]), int(header["voltage_steps"]))
+            text, start, size = _layout(header, shape, extras)
+            with open(filename, 'wb') as scanfile:
+                scanfile.write(MAGIC + struct.pack("<Q", len(text)) + text)
+                scanfile.write(b"\0" * (start - scanfile.tell()))
+                scanfile.truncate(size)
+            descriptor = json.loads(text)
+        self.filename = filename
+        self.arrays = {name: np.memmap(filename, dtype=info["dtype"], mode='r+',
+                                       offset=info["offset"], shape=tuple(info["shape"]))
+                       for name, info in descriptor["arrays"].items()}
+        if not resume:
+            for name in EXTRA_ARRAYS:
+                if name in self.arrays:
+                    self.arrays[name][:] = np.nan
+
+    def write_row(self, index, row, timestamps=None, positions=None):
+        self.arrays["grid"][index] = row
+        for name, values in [("timestamps", timestamps), ("positions", positions)]:
+            if values is not None and name in self.arrays:
+                self.arrays[name][index] = values
+        for array in self.arrays.values():
+            array.flush()
+
+    def close(self):
+        for array in self.arrays.values():
+            array.flush()
+        self.arrays = {}
+
+def write_scan(filename, header, grid, timestamps=None, positions=None):
+    extras = [name for name, values in [("timestamps", timestamps), ("positions", positions)]
+              if values is not None]
+    writer = ScanFileWriter(filename, header, extras)
+    grid = np.asarray(grid, dtype=float)
+    for index in range(grid.shape[0]):
+        writer.write_row(index, grid[index],
+                         None if timestamps is None else timestamps[index],
+                         None if positions is None else positions[index])
+    writer.close()
+
+# the JSON descriptor of a file name, or of the bytes of a whole scan
+def _read_descriptor(source):
+    start = len(MAGIC) + 8
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        buffer = source
+    else:
+        with open(source, 'rb') as scanfile:
+            buffer = scanfile.read(start)
+            if buffer[:len(MAGIC)] == MAGIC and len(buffer) == start:
+                buffer += scanfile.read(struct.unpack("<Q", buffer[len(MAGIC):])[0])
+    if bytes(buffer[:len(MAGIC)]) != MAGIC or len(buffer) < start:
+        raise ValueError("not a binary scan file")
+    (length,) = struct.unpack("<Q", bytes(buffer[len(MAGIC):start]))
+    return json.loads(bytes(buffer[start:start + length]).decode())
+
+# Returns the header dict, the grid (positions x voltages) and a dict of the extra arrays,
+# all arrays are read-only views of the file (or of the bytes passed in)
+def read_scan(source):
+    descriptor = _read_descriptor(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        arrays = {name: np.frombuffer(source, dtype=info["dtype"], count=int(np.prod(info["shape"])),
+                                      offset=info["offset"]).reshape(info["shape"])
+                  for name, info in descriptor["arrays"].items()}
+    else:
+        arrays = {name: np.memmap(source, dtype=info["dtype"], mode='r', offset=info["offset"],
+                                  shape=tuple(info["shape"]))
+                  for name, info in descriptor["arrays"].items()}
+    grid = arrays.pop("grid")
+    return descriptor["header"], grid, arrays
+
+def read_header(source):
+    return _read_descriptor(source)["header"]
+
+# .dat compatibility
+def write_dat(filename, header, grid):
+    with open(filename, 'w') as datafile:
+        datafile.write(header["comment"] + "\n")
+        datafile.write(f"{header['plate_length']:g} {header['plate_gap']:g}\n")
+        for key in ["beam_energy", "motor_start", "motor_step_size", "voltage_min",
+                    "voltage_step_size", "voltage_steps", "position_steps"]:
+            datafile.write(str(header[key]) + "\n")
+        for row in np.asarray(grid):
+            datafile.write("".join(str(value) + " " for value in row) + "\n")
+
+def dat_to_scan(dat_filename, scan_filename=None):
+    import do_contour
+    scan_filename = scan_filename or os.path.splitext(dat_filename)[0] + EXTENSION
+    header, grid = do_contour.read_scan(dat_filename)
+    write_scan(scan_filename, header, grid)
+    return scan_filename
+
+def scan_to_dat(scan_filename, dat_filename=None):
+    dat_filename = dat_filename or os.path.splitext(scan_filename)[0] + ".dat"
+    header, grid, _ = read_scan(scan_filename)
+    write_dat(dat_filename, header, grid)
+    return dat_filename
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert between .dat and binary .scan files")
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args(argv)
+    for filename in args.files:
+        if is_binary_scan(filename):
+            print(filename, "->", scan_to_dat(filename))
+        else:
+            print(filename, "->", dat_to_scan(filename))
+
+if __name__ == "__main__":
+    main()
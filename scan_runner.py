@@ -0,0 +1,216 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import batch_analysis
+import calibration
+import motor_control_galil as mc
+import scan_engine
+import scan_format
+import scan_scheduler
+
+# Headless scan runner
+# Runs a queue of scans from JSON recipe files back to back without the GUI (no PySide6):
+#   python scan_runner.py overnight.json
+#   python scan_runner.py first.json second.json --dry-run
+# A recipe file holds a list of recipes, or {"defaults": {...}, "scans": [...]} where
+# every scan starts from the defaults. Recipe keys:
+#   comment, energy                     beam energy in V, must be a number (the analysis needs it)
+#   start_mm, end_mm                    position range in mm from Park, like the GUI inputs,
+#   or start_motor, end_motor           the range in motor steps
+#   motor_num_steps
+#   start_voltage, end_voltage, voltage_num_steps
+#   filename (optional)                 default datafile_<date>_<time> in the results directory
+#   any of SCAN_OPTIONS, see scan_engine
+# The controller address and results directory come from properties.json, as for the GUI.
+# The motor is calibrated once at the start with calibration.calibrate. The queue runs through
+# scan_scheduler.run_series: every finished scan is analysed in a process pool while the motor
+# already moves on to the next one, and the results fill in a CSV table (--table, default
+# series_<date>_<time>.csv in the results directory). After the last scan the motor returns to
+# the Faraday cup. A failed scan does not stop the queue unless --stop-on-error,
+# Ctrl-C aborts the running scan (it keeps its checkpoint, see scan_engine.resume_scan)
+
+PROPERTIES_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "properties.json")
+# same as the GUI's auto scan
+DEFAULT_RECIPE = {
+    "comment": "",
+    "energy": 25000,
+    "start_mm": 160,
+    "end_mm": 190,
+    "motor_num_steps": 10,
+    "start_voltage": -2,
+    "end_voltage": 2,
+    "voltage_num_steps": 50,
+}
+SCAN_OPTIONS = ["controller_sweep", "fly_scan", "settle", "settle_tolerance", "settle_window",
+                "settle_timeout", "settle_interval", "settle_min_dwell", "serpentine", "adaptive",
+                "coarse_factor", "roi_margin", "binary", "estimate", "early_stop", "early_stop_tolerance", "early_stop_rows"]
+RECIPE_KEYS = set(DEFAULT_RECIPE) | {"start_motor", "end_motor", "filename"} | set(SCAN_OPTIONS)
+
+# the recipes of one file, each merged with the file's defaults
+def load_recipes(filename):
+    with open(filename) as jsonfile:
+        data = json.load(jsonfile)
+    if isinstance(data, list):
+        data = {"scans": data}
+    defaults = dict(DEFAULT_RECIPE)
+    defaults.update(data.get("defaults", {}))
+    recipes = []
+    for number, scan in enumerate(data["scans"]):
+        recipe = dict(defaults)
+        recipe.update(scan)
+        unknown = set(recipe) - RECIPE_KEYS
+        if unknown:
+            raise ValueError(f"{filename} scan {number + 1}: unknown keys {sorted(unknown)}")
+        try:
+            float(recipe["energy"])
+        except (TypeError, ValueError):
+            raise ValueError(f"{filename} scan {number + 1}: energy {recipe['energy']!r} is not a number")
+        recipe["source"] = f"{os.path.basename(filename)} #{number + 1}"
+        recipes.append(recipe)
+    return recipes
+
+# a file name like the GUI's that is not taken yet
+def new_filename(results_dir, binary=False, taken=()):
+    extension = scan_format.EXTENSION if binary else ".dat"
+    base = os.path.join(results_dir, "datafile_" + time.strftime("%Y-%m-%d_%H-%M"))
+    filename = base + extension
+    count = 1
+    while os.path.exists(filename) or filename in taken:
+        count += 1
+        filename = f"{base}_{count}{extension}"
+    return filename
+
+# the scan_engine scan dict for a recipe, like MainWindow.do_measurement builds it
+def build_scan(recipe, switches, results_dir, taken=()):
+    if "start_motor" in recipe and "end_motor" in recipe:
+        start_motor, end_motor = int(recipe["start_motor"]), int(recipe["end_motor"])
+    else:
+        start_motor = calibration.position_from_mm(switches, recipe["start_mm"])
+        end_motor = calibration.position_from_mm(switches, recipe["end_mm"])
+    for position in [start_motor, end_motor]:
+        if not switches["home"] <= position <= switches["end"]:
+            raise ValueError(f"{recipe['source']}: position {position} is outside the switches "
+                             f"{switches['home']} - {switches['end']}")
+    filename = recipe.get("filename")
+    if filename:
+        filename = os.path.join(results_dir, filename)
+    else:
+        filename = new_filename(results_dir, recipe.get("binary", False), taken)
+    scan = {
+        "filename": filename,
+        "comment": str(recipe["comment"]),
+        "energy": str(recipe["energy"]),
+        "motor_start_mm": calibration.position_in_mm(switches, start_motor),
+        "steps_to_mm": calibration.steps_to_mm(switches),
+        "start_motor": start_motor,
+        "end_motor": end_motor,
+        "motor_num_steps": int(recipe["motor_num_steps"]),
+        "start_voltage": float(recipe["start_voltage"]),
+        "end_voltage": float(recipe["end_voltage"]),
+        "voltage_num_steps": int(recipe["voltage_num_steps"]),
+        "calibration": dict(switches),
+    }
+    for key in SCAN_OPTIONS:
+        if key in recipe:
+            scan[key] = recipe[key]
+    return scan
+
+def park_at_faraday(switches):
+    mc.set_output_voltage(0)
+    mc.move_to_position(switches["faraday"], speed=200000, final_speed=50000)
+    scan_engine.wait_for_motion(0.1)
+
+def print_row(row):
+    if row["error"]:
+        print(f"[{row['scan']}] {row['source']}: {row['file']} FAILED {row['error']}")
+    else:
+        print(f"[{row['scan']}] {row['source']}: {row['file']} emittance {row['emittance']:.3f}, "
+              f"scan took {row['duration_s']:.0f} s")
+
+# run the recipes in order, returns one scan_scheduler table row each
+def run_queue(recipes, switches, results_dir, stop_on_error=False, table=None, sigma=0.6, cut=0.3,
+              workers=None):
+    scans = []
+    for recipe in recipes:
+        scan = build_scan(recipe, switches, results_dir, [scan["filename"] for scan in scans])
+        scan["source"] = recipe["source"]
+        scans.append(scan)
+    try:
+        return scan_scheduler.run_series(scans, sigma, cut, table, print_row, workers,
+                                         lambda scan, completed: completed or not stop_on_error)
+    except KeyboardInterrupt:
+        print("interrupted, the rest of the queue is skipped")
+        return []
+    finally:
+        park_at_faraday(switches)
+
+def load_properties(filename):
+    with open(filename) as jsonfile:
+        return json.load(jsonfile)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a queue of emittance scans from JSON recipes without the GUI")
+    parser.add_argument("recipes", nargs="+", help="recipe files, run in the given order")
+    parser.add_argument("--properties", default=PROPERTIES_FILE)
+    parser.add_argument("--results-dir", default=None, help="instead of saveLocation from the properties")
+    parser.add_argument("--simulate", action="store_true", help="run against motor_control_fake, no hardware needed")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="with --simulate, run simulated time faster")
+    parser.add_argument("--dry-run", action="store_true", help="check the recipes and print the queue, no motion")
+    parser.add_argument("--stop-on-error", action="store_true")
+    parser.add_argument("-o", "--summary", default=None, help="write the queue results to this JSON file")
+    parser.add_argument("--table", default=None, help="CSV table filled in as analyses finish")
+    parser.add_argument("--sigma", type=float, default=0.6)
+    parser.add_argument("--cut", type=float, default=0.3)
+    parser.add_argument("--workers", type=int, default=None, help="analysis processes, default one per core")
+    args = parser.parse_args(argv)
+
+    recipes = []
+    for filename in args.recipes:
+        recipes += load_recipes(filename)
+    if args.dry_run:
+        for recipe in recipes:
+            print(json.dumps(recipe))
+        print(len(recipes), "scans queued")
+        return 0
+
+    properties = {"address": "simulated"} if args.simulate else load_properties(args.properties)
+    results_dir = args.results_dir or properties.get("saveLocation", ".")
+    os.makedirs(results_dir, exist_ok=True)
+    if args.simulate:
+        import motor_control_fake
+        motor_control_fake.install(time_scale=args.time_scale)
+    mc.configure_connection(properties)
+    mc.setup(properties["address"])
+    if not mc.is_connected():
+        # without the GUI nobody waits for the controller to come up
+        return 1
+    if "statusTTL" in properties:
+        mc.set_status_ttl(properties["statusTTL"])
+
+    results = []
+    try:
+        switches = calibration.calibrate()
+        if switches is None:
+            print("Calibration failed, no limit switch found")
+            return 1
+        print("calibration", switches)
+        table = args.table or os.path.join(results_dir, "series_" + time.strftime("%Y-%m-%d_%H-%M") + ".csv")
+        results = run_queue(recipes, switches, results_dir, args.stop_on_error, table, args.sigma, args.cut,
+                            args.workers)
+    finally:
+        mc.cleanup()
+    print(f"{'scan':<6}{'source':<24}{'emittance':>12}{'duration s':>12}  file")
+    for row in results:
+        emittance = f"{row['emittance']:.3f}" if "emittance" in row else "-"
+        print(f"{row['scan']:<6}{row['source'][:23]:<24}{emittance:>12}{row['duration_s']:>12.0f}  "
+              f"{os.path.basename(row['file'])} {row['error']}")
+    print("results table", table)
+    if args.summary:
+        batch_analysis.write_json(results, args.summary)
+    return 0 if results and all(result["completed"] for result in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
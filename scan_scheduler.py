@@ -0,0 +1,93 @@
+import csv
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import batch_analysis
+import motor_control_galil as mc
+import scan_engine
+
+# Pipelined scan series
+# Scans run one after another on the calling thread. Each finished file goes to a process pool
+# for analysis (batch_analysis.summarise) and the motor starts its approach to the next scan's
+# first position straight away, so the next scan is moving while the last one is analysed.
+# Summaries arrive in completion order: each one is passed to callback and appended (and flushed)
+# to a CSV table, so the table fills in while the series is still running
+# This file must not import PySide6
+
+TABLE_FIELDS = ["scan", "source", "file", "completed", "duration_s", "comment", "beam_energy",
+                "emittance", "x2RMS", "theta2RMS", "sigma", "cut", "error"]
+
+# move towards the first position of scan without waiting, run_scan waits for the move to end
+# before it sends its own
+def approach(scan):
+    mc.set_output_voltage(0)
+    mc.move_to_position(scan["start_motor"], speed=scan_engine.SCAN_SPEED)
+
+# Run scans (scan_engine scan dicts, optionally with a "source" entry naming the recipe)
+# in order, returns one table row per scan in scan order
+# after_scan(scan, completed) runs before the next scan starts, when it returns False the
+# series stops, e.g. for stop on error
+def run_series(scans, sigma=0.6, cut=0.3, table=None, callback=None, workers=None, after_scan=None):
+    scans = list(scans)
+    rows = []
+    lock = threading.Lock()
+    csvfile = None
+    writer = None
+    if table:
+        csvfile = open(table, 'w', newline='')
+        writer = csv.DictWriter(csvfile, fieldnames=TABLE_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        csvfile.flush()
+
+    def publish(row):
+        with lock:
+            if writer:
+                writer.writerow(row)
+                csvfile.flush()
+            if callback:
+                callback(row)
+
+    def analysed(row, future):
+        try:
+            summary = future.result()
+        except Exception as e:
+            summary = {"error": repr(e)}
+        # the table keeps the scan's own file name, the summary has the base name
+        summary.pop("file", None)
+        row.update(summary)
+        publish(row)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for number, scan in enumerate(scans):
+                row = {"scan": number + 1, "source": scan.get("source", ""), "file": scan["filename"],
+                       "completed": False, "duration_s": 0.0, "comment": scan.get("comment", ""), "error": ""}
+                rows.append(row)
+                start = time.monotonic()
+                try:
+                    row["completed"] = scan_engine.run_scan({k: v for k, v in scan.items() if k != "source"})
+                except KeyboardInterrupt:
+                    scan_engine.abort()
+                    row["error"] = "interrupted"
+                    publish(row)
+                    raise
+                except Exception as e:
+                    row["error"] = repr(e)
+                    print("scan failed", e)
+                row["duration_s"] = time.monotonic() - start
+                if row["completed"]:
+                    pool.submit(batch_analysis.summarise, scan["filename"], sigma, cut).add_done_callback(
+                        lambda future, row=row: analysed(row, future))
+                else:
+                    row["error"] = row["error"] or "scan did not complete"
+                    publish(row)
+                if after_scan and after_scan(scan, row["completed"]) is False:
+                    break
+                if number + 1 < len(scans):
+                    approach(scans[number + 1])
+            # leaving the with block waits for the analyses still running
+    finally:
+        if csvfile:
+            csvfile.close()
+    return rows
@@ -0,0 +1,82 @@
+import builtins
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Startup timing report
+#   python emittance_scanner.py --startup-report
+# (or EMITTANCE_STARTUP_REPORT=1) times every module imported from then on and each
+# construction phase wrapped in phase(), and prints the slowest of them once the window
+# is up. Import this before anything else so it sees the other imports
+# Without the flag, phase() and report() cost next to nothing and print nothing
+
+FLAG = "--startup-report"
+ENV_VARIABLE = "EMITTANCE_STARTUP_REPORT"
+REPORT_LIMIT = 25   # modules listed
+
+enabled = False
+imports = {}        # module name: [cumulative seconds, seconds excluding its own imports]
+phases = []         # (name, seconds) in order
+_start = time.perf_counter()
+_original_import = builtins.__import__
+_local = threading.local()  # per thread: time spent in nested imports, one entry per import in progress
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level != 0 or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    stack = _local.__dict__.setdefault("stack", [])
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        imports[name] = [elapsed, elapsed - nested]
+
+def enable():
+    global enabled
+    if enabled:
+        return
+    enabled = True
+    builtins.__import__ = _timed_import
+
+def disable():
+    builtins.__import__ = _original_import
+
+def requested(argv=None):
+    return FLAG in (sys.argv if argv is None else argv) or os.environ.get(ENV_VARIABLE, "") not in ("", "0")
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if enabled:
+            phases.append((name, time.perf_counter() - start))
+
+def format_report(limit=REPORT_LIMIT):
+    total = time.perf_counter() - _start
+    lines = [f"startup took {total:.2f} s"]
+    lines.append(f"{'phase':<40}{'s':>8}")
+    for name, seconds in phases:
+        lines.append(f"{name:<40}{seconds:>8.3f}")
+    lines.append(f"{'module (slowest first)':<40}{'total s':>8}{'self s':>8}")
+    for name, (cumulative, own) in sorted(imports.items(), key=lambda item: -item[1][0])[:limit]:
+        lines.append(f"{name[:39]:<40}{cumulative:>8.3f}{own:>8.3f}")
+    return "\n".join(lines)
+
+# print the report and stop timing imports, the warm-up and later imports are not startup
+def report():
+    if not enabled:
+        return
+    disable()
+    print(format_report())
+
+if requested():
+    enable()
@@ -0,0 +1,25 @@
+import numpy as np
+
+import scan_engine
+
+def test_roi_between_fine_points_keeps_the_nearest():
+    # margin 0 around a beam in the middle coarse cell, 450 falls between fine points
+    coarse_positions = np.linspace(0, 900, 3)
+    coarse_voltages = np.linspace(-1, 1, 3)
+    grid = [[0, 0, 0], [0, 1, 0], [0, 0, 0]]
+    position_lo, position_hi, voltage_lo, voltage_hi, background = scan_engine.find_roi(
+        grid, coarse_positions, coarse_voltages, margin=0)
+    assert (position_lo, position_hi) == (450, 450)
+    positions = np.linspace(0, 900, 10)
+    voltages = np.linspace(-1, 1, 10)
+    assert scan_engine.roi_index_range(positions, position_lo, position_hi) == [4, 4]
+    assert scan_engine.roi_index_range(voltages, voltage_lo, voltage_hi) == [4, 4]
+
+def test_roi_index_range():
+    values = np.linspace(0, 900, 10)
+    assert scan_engine.roi_index_range(values, 0, 900) == [0, 9]
+    assert scan_engine.roi_index_range(values, 180, 420) == [2, 4]
+    assert scan_engine.roi_index_range(values, -50, 2000) == [0, 9]
+    # scans may run downwards
+    assert scan_engine.roi_index_range(values[::-1], 180, 420) == [5, 7]
+    assert scan_engine.roi_index_range(np.array([5.0]), 0, 1) == [0, 0]
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+import do_contour
+
+# the element by element loops do_contour.run used before background_cut
+def original_background_cut(df, cut):
+    voltage_steps, position_steps = df.shape
+    for j in range(position_steps):
+        for i in range(voltage_steps-1):
+            if (df[i,j] != 0) and (df[i-1,j] < cut*np.max(df)) and (df[i+1,j] < cut*np.max(df)):
+                df[i,j] = 0
+
+    for i in range(voltage_steps):
+        for j in range(position_steps-1):
+            if (df[i,j] != 0) and (df[i,j-1] < cut*np.max(df)) and (df[i,j+1] < cut*np.max(df)):
+                df[i,j] = 0
+    return df
+
+def grids():
+    rng = np.random.default_rng(1)
+    for shape in [(1, 1), (1, 6), (6, 1), (2, 2), (3, 5), (12, 9), (30, 20)]:
+        yield rng.random(shape)
+        yield rng.normal(0.0, 1.0, shape)
+        yield -rng.random(shape) - 0.1                      # all negative
+        yield rng.integers(0, 4, shape).astype(float)       # zeros and repeated maxima
+    # a narrow beam on a noisy background, like a real scan
+    voltage, position = np.meshgrid(np.linspace(-1, 1, 40), np.linspace(-1, 1, 25), indexing='ij')
+    yield np.exp(-(voltage ** 2 + position ** 2) / 0.05) + 0.02 * rng.random(voltage.shape)
+
+@pytest.mark.parametrize("cut", [0.0, 0.3, 0.6, 1.0])
+def test_background_cut_matches_original_loops(cut):
+    for grid in grids():
+        expected = original_background_cut(grid.copy(), cut)
+        result = do_contour.background_cut(grid.copy(), cut)
+        np.testing.assert_array_equal(result, expected)
+
+def test_beam_moments_match_original_sums():
+    rng = np.random.default_rng(2)
+    df = rng.random((15, 10))
+    xVector = np.linspace(0, 9, 10)
+    thetaVector = np.linspace(-1, 1, 15)
+    x2RMS, theta2RMS, emittance, xNew, thetaNew = do_contour.beam_moments(df, xVector, thetaVector)
+
+    xS = df.sum(axis=0) * (1/15)
+    thetaS = df.sum(axis=1) * (1/10)
+    xWeighted = sum([xVector[i] * xS[i] for i in range(10)]) / xS.sum()
+    thetaWeighted = sum([thetaVector[i] * thetaS[i] for i in range(15)]) / thetaS.sum()
+    expected_x = 2 * np.sqrt(sum([np.square(xVector[i] - xWeighted) * xS[i] for i in range(10)]) / xS.sum())
+    expected_theta = 2 * np.sqrt(sum([np.square(thetaVector[i] - thetaWeighted) * thetaS[i] for i in range(15)]) / thetaS.sum())
+    assert x2RMS == pytest.approx(expected_x, rel=1e-12)
+    assert theta2RMS == pytest.approx(expected_theta, rel=1e-12)
+    assert emittance == pytest.approx(x2RMS * theta2RMS * np.sqrt(1 - np.square(
+        np.dot(df.dot(xNew), thetaNew) / x2RMS / theta2RMS * 4 / df.sum())), rel=1e-12)
@@ -0,0 +1,171 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import benchmark
+import galil_tcp
+import motor_control_fake
+import motor_control_galil as mc
+import scan_engine
+
+# Outages against galil_tcp.StandInServer serving a simulated controller, see the
+# Connection manager in motor_control_galil
+
+SETTINGS = ["command_timeout", "command_retries", "reconnect_interval", "keepalive_interval", "call_timeout"]
+
+@pytest.fixture
+def link():
+    saved = {name: getattr(mc, name) for name in SETTINGS}
+    mc.command_timeout = 0.2
+    mc.reconnect_interval = 0.2
+    mc.keepalive_interval = 0.3
+    mc.call_timeout = 5.0
+    events = []
+    mc.set_connection_listener(lambda connected, message: events.append(connected))
+    simulator = motor_control_fake.SimulatedGalil(latency=0.0005, jitter=0, start_position=0)
+    server = galil_tcp.StandInServer(simulator).start()
+    mc.setup(server.address)
+    link = {"simulator": simulator, "server": server, "events": events}
+    yield link
+    mc.stop_io_thread()
+    link["server"].stop()
+    mc.set_connection_listener(None)
+    for name, value in saved.items():
+        setattr(mc, name, value)
+
+def test_unreachable_controller_at_setup_is_opened_later(link):
+    # a port nobody listens on yet
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    simulator = motor_control_fake.SimulatedGalil(latency=0.0005, jitter=0, start_position=0)
+    simulator.speed = 50000
+    link["events"].clear()
+    mc.setup(galil_tcp.SCHEME + "127.0.0.1:%d" % port)
+    assert not mc.is_connected()
+    assert link["events"] == [False]
+    mc.start_io_thread(None, 0.05)
+    link["server"].stop()
+    link["server"] = galil_tcp.StandInServer(simulator, port=port).start()
+    deadline = time.monotonic() + 3.0
+    while not mc.is_connected() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert mc.is_connected()
+    # the first open that gets through sends the setup
+    assert simulator.speed == 10000
+
+def test_read_is_retried_after_a_dropped_connection(link):
+    link["server"].drop_connections()
+    start = time.monotonic()
+    mc.read_analog_input()
+    assert time.monotonic() - start < 1.0
+    assert mc.is_connected()
+    assert link["events"] == [True, False, True]
+
+def test_move_is_resent_after_a_dropped_connection(link):
+    link["server"].drop_connections()
+    mc.move_to_position(1000)
+    scan_engine.running = True
+    scan_engine.wait_for_motion(0.05)
+    assert mc.get_position(0) == 1000
+
+def test_move_whose_reply_was_lost_is_not_started_twice(link):
+    # the controller runs PA;BG but the reply is held back past command_timeout
+    link["server"].stall_for(0.3)
+    mc.move_to_position(500000, speed=100000)
+    # a second BG would have been rejected while the axis moves
+    assert mc.is_in_motion()
+    mc.stop_motor()
+
+def test_relative_move_is_not_resent_after_a_dropped_connection(link):
+    link["server"].drop_connections()
+    with pytest.raises(mc.ConnectionLost):
+        mc.command('PR1000;BG')
+    # the link itself is back for the next call
+    assert mc.get_position(0) == 0
+
+def test_stalled_link_fails_within_the_timeout_and_recovers(link):
+    link["server"].stall_for(2.0)
+    start = time.monotonic()
+    with pytest.raises(mc.ConnectionLost):
+        mc.read_analog_input()
+    assert time.monotonic() - start < 1.5
+    # the idle I/O thread reconnects in the background once the link passes packets again
+    mc.start_io_thread(None, 0.05)
+    deadline = time.monotonic() + 5.0
+    while not mc.is_connected() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert mc.is_connected()
+    mc.read_analog_input()
+
+def test_restarted_server_is_reconnected(link):
+    mc.start_io_thread(None, 0.05)
+    port = link["server"].server_address[1]
+    link["server"].stop()
+    time.sleep(0.5)
+    assert not mc.is_connected()
+    link["server"] = galil_tcp.StandInServer(link["simulator"], port=port).start()
+    deadline = time.monotonic() + 3.0
+    while not mc.is_connected() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert mc.is_connected()
+    assert mc.get_position(0) == 0
+
+def test_wait_for_motion_ends_when_the_link_is_lost(link):
+    mc.move_to_position(500000, speed=1000)
+    scan_engine.running = True
+    errors = []
+    def wait():
+        try:
+            scan_engine.wait_for_motion(0.05)
+        except mc.ConnectionLost as e:
+            errors.append(e)
+    waiter = threading.Thread(target=wait, daemon=True)
+    waiter.start()
+    time.sleep(0.3)
+    link["server"].stop()
+    waiter.join(3.0)
+    # a lost link used to read as "still moving" and the wait never ended
+    scan_engine.abort()
+    waiter.join(1.0)
+    assert len(errors) == 1
+
+def test_reconnect_keeps_the_commanded_speed(link):
+    mc.set_speed(200000)
+    link["server"].drop_connections()
+    mc.read_analog_input()
+    assert link["simulator"].speed == 200000
+
+def test_reconnect_restores_the_switch_polarity(link):
+    simulator = link["simulator"]
+    received = []
+    command = simulator.GCommand
+    simulator.GCommand = lambda cmd: received.append(cmd) or command(cmd)
+    link["server"].drop_connections()
+    mc.read_analog_input()
+    assert any("CN1,-1,1" in cmd for cmd in received)
+    assert not any("SP" in cmd for cmd in received)
+
+def test_listener_set_through_the_simulator_module(link):
+    # motor_control_fake re-exports the driver, the listener has to reach the driver's globals
+    events = []
+    motor_control_fake.set_connection_listener(lambda connected, message: events.append(connected))
+    link["server"].drop_connections()
+    mc.read_analog_input()
+    assert events == [False, True]
+    assert motor_control_fake.is_connected()
+
+def test_sweep_is_started_after_a_dropped_connection(link):
+    assert len(mc.sweep_voltage(-1, 1, 5, 0.01)) == 5
+    link["server"].drop_connections()
+    assert len(mc.sweep_voltage(-1, 1, 5, 0.01)) == 5
+
+def test_scan_fails_cleanly_when_the_link_is_lost_during_the_approach(link, tmp_path):
+    mc.move_to_position(500000, speed=1000)
+    threading.Timer(0.3, link["server"].stop).start()
+    scan = benchmark.synthetic_scan(str(tmp_path / "a.dat"), 3, 5)
+    assert scan_engine.run_scan(scan) is False
+    assert not scan_engine.running
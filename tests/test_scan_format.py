@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+import do_contour
+import scan_format
+
+HEADER = {
+    "comment": "round trip",
+    "plate_length": 40.78,
+    "plate_gap": 4.0,
+    "beam_energy": 25000.0,
+    "motor_start": 160.0,
+    "motor_step_size": 3.0,
+    "voltage_min": -2.0,
+    "voltage_step_size": 0.08,
+    "voltage_steps": 5,
+    "position_steps": 4,
+}
+
+def make_grid():
+    rng = np.random.default_rng(3)
+    return rng.random((HEADER["position_steps"], HEADER["voltage_steps"]))
+
+def test_write_then_read_scan(tmp_path):
+    filename = str(tmp_path / "a.scan")
+    grid = make_grid()
+    timestamps = np.arange(grid.size, dtype=float).reshape(grid.shape) + 1e9
+    positions = np.arange(grid.size, dtype=float).reshape(grid.shape) * 10
+    scan_format.write_scan(filename, HEADER, grid, timestamps, positions)
+
+    assert scan_format.is_binary_scan(filename)
+    assert scan_format.read_header(filename) == HEADER
+    header, read_grid, extras = scan_format.read_scan(filename)
+    assert header == HEADER
+    np.testing.assert_array_equal(read_grid, grid)
+    np.testing.assert_array_equal(extras["timestamps"], timestamps)
+    np.testing.assert_array_equal(extras["positions"], positions)
+
+    # the same from the bytes of the file
+    with open(filename, 'rb') as scanfile:
+        data = scanfile.read()
+    header, read_grid, extras = scan_format.read_scan(data)
+    assert header == HEADER
+    np.testing.assert_array_equal(read_grid, grid)
+    np.testing.assert_array_equal(extras["positions"], positions)
+
+def test_resumed_writer_keeps_the_rows_written(tmp_path):
+    filename = str(tmp_path / "a.scan")
+    grid = make_grid()
+    writer = scan_format.ScanFileWriter(filename, HEADER)
+    writer.write_row(0, grid[0], timestamps=[1.0] * len(grid[0]))
+    writer.close()
+    writer = scan_format.ScanFileWriter(filename, None, resume=True)
+    for index in range(1, len(grid)):
+        writer.write_row(index, grid[index])
+    writer.close()
+    header, read_grid, extras = scan_format.read_scan(filename)
+    np.testing.assert_array_equal(read_grid, grid)
+    assert np.all(extras["timestamps"][0] == 1.0)
+    # points without a timestamp stay NaN
+    assert np.all(np.isnan(extras["timestamps"][1:]))
+
+def test_dat_and_scan_convert_both_ways(tmp_path):
+    grid = make_grid()
+    dat = str(tmp_path / "a.dat")
+    scan_format.write_dat(dat, HEADER, grid)
+    scan = scan_format.dat_to_scan(dat)
+    header, read_grid, extras = scan_format.read_scan(scan)
+    assert header == do_contour.read_scan(dat)[0]
+    np.testing.assert_array_equal(read_grid, grid)
+    assert extras == {}
+
+    back = scan_format.scan_to_dat(scan, str(tmp_path / "b.dat"))
+    header, read_grid = do_contour.read_scan(back)
+    assert header == do_contour.read_scan(dat)[0]
+    np.testing.assert_array_equal(read_grid, grid)
+
+def test_dat_file_is_not_a_binary_scan(tmp_path):
+    dat = str(tmp_path / "a.dat")
+    scan_format.write_dat(dat, HEADER, make_grid())
+    assert not scan_format.is_binary_scan(dat)
+    with pytest.raises(ValueError):
+        scan_format.read_header(dat)
+    with pytest.raises(ValueError):
+        scan_format.read_header(scan_format.MAGIC + b"\0")
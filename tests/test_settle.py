@@ -0,0 +1,25 @@
+import time
+
+import pytest
+
+import motor_control_fake
+import motor_control_galil as mc
+
+# adaptive settle against a detector that follows AO2 with a first order lag
+
+@pytest.mark.parametrize("response_time", [0.01, 0.05])
+def test_settled_reading_is_close_to_the_final_value(response_time):
+    beam = dict(motor_control_fake.DEFAULT_BEAM, response_time=response_time)
+    simulator = motor_control_fake.SimulatedGalil(0.001, 0.0, beam=beam, start_position=beam["position"])
+    mc.use_connector(simulator)
+    mc.setup("simulated")
+    mc.set_output_voltage(-2)
+    time.sleep(0.5)
+    # step onto the beam peak, the input rises by about 1 V
+    mc.set_output_voltage(0)
+    value, elapsed, settled = mc.settle_analog_input()
+    time.sleep(20 * response_time)
+    final = sum(mc.read_analog_input() for _ in range(10)) / 10
+    assert settled
+    assert elapsed >= 0.02
+    assert abs(value - final) < 0.01